@@ -2,12 +2,9 @@
 """
 Collect frequencies for data files from given directory.
 """
-import os.path as path
 import argparse
-import glob
 
-import numpy as np
-import parusFile as pf
+import parusCatalog as pc
 # import parusPlot as pplt
 
 
@@ -25,15 +22,12 @@ if __name__ == '__main__':
     # 0. Get working parameters.
     parser = createParser()
     namespace = parser.parse_args()
-    names = glob.glob(path.join(namespace.directory, '*.frq'))
+    # Collect information from the catalog of headers.
+    catalog = pc.parusCatalog(namespace.directory)
+    catalog.refresh()
+    names = catalog.names()
+    frqs_unique = catalog.frequencies()
+    catalog.close()
 
-    arrFrqs = np.array([], dtype=np.uint32)
-    for name in names:
-        # Parsing data and collect information.
-        # print(name)
-        A = pf.parusFile(name)
-        arrFrqs = np.append(arrFrqs, A.frqs)
-
-    frqs_unique = np.unique(arrFrqs)
     print(len(names))
     print(frqs_unique)
@@ -3,15 +3,16 @@
 Work with data file. Use a spectral algorithm.
 Control: http://space-weather.ru/index.php?page=ionogrammy
 """
-import os.path as path
 import argparse
-import glob
 
 from datetime import datetime
 import numpy as np
 import sqlite3
 
 import parusFile as pf
+import parusCatalog as pc
+import parusDB as pdb
+import parusCache as pcache
 import parusPlot as pplt
 
 
@@ -23,6 +24,14 @@ def createParser():
     parser.add_argument(
         '-f', '--file',
         default='parus_psd.sqlite')
+    parser.add_argument(
+        '--cache',
+        default=pcache.parusCache.defaultDirectory(),
+        help='directory of the cache of results')
+    parser.add_argument(
+        '--no-cache',
+        dest='cache', action='store_const', const=None,
+        help='do not use the cache of results')
 
     return parser
 
@@ -32,7 +41,10 @@ if __name__ == '__main__':
     # 0. Get working parameters.
     parser = createParser()
     namespace = parser.parse_args()
-    names = glob.glob(path.join(namespace.directory, '*.frq'))
+    catalog = pc.parusCatalog(namespace.directory)
+    catalog.refresh()
+    names = catalog.names()
+    catalog.close()
 
     # Create a connection and cursor to your database
     # if file not exist - create empty database
@@ -47,12 +59,12 @@ if __name__ == '__main__':
     if not data[0][0]:
         raise ValueError('Database is empty or corrupted.')
 
-    # In sqlite3 foreign key constraints are disabled by default
-    # for performance reasons. PRAGMA statement enables them.
-    cur.execute("PRAGMA foreign_keys = ON")
+    # Writer of results, every file is committed after the dialog.
+    writer = pdb.parusWriter(conn, batchSize=1)
 
     i_file = 0
     n_files = len(names)
+    cache = pcache.parusCache(namespace.cache) if namespace.cache else None
 
     for name in names:
         # 0. View reflections on every frequencies.
@@ -60,48 +72,19 @@ if __name__ == '__main__':
         #view.start()
 
         # 1. Get amplitudes of reflections.
-        A = pf.parusFile(name)
-        ave, ave2, _h, _a = A.getAveragedMeans()
+        A = pf.parusFile(name, cache=cache)
+        # profiles and spectral results by single pass of the file
+        full = A.FullCalculation(('statistics', 'spectral'))
+        stats = full['statistics']
+        ave, ave2, _h, _a = (
+            stats['mean'], stats['rms'], stats['heights'], stats['amplitudes'])
         _alog = 20*np.log10(_a)
         _L = _alog[:,0] - _alog[:,1] - 6  # db
         print(_L, _h[:,1]-_h[:,0])
         pplt.plotAveragedLines(name, A.heights, A.frqs, ave, ave2)
 
-        # 2. Save results in sqlite Database.
-        # Fill file table.
-        ftime = datetime(*A.time[:6])
-        cur.execute(
-            'SELECT id_file FROM files WHERE filename=?', (A.name,))
-        data = cur.fetchall()
-        if data:  # exist
-            file_id = data[0][0]
-        else:  # create record
-            cur.execute(
-                'insert into files '
-                '(filename, time, dt, dh) values (?,?,?,?)',
-                (A.name, ftime, A.dt, A.heights[1] - A.heights[0]))
-            file_id = cur.lastrowid
-
-        # Fill frequencies table.
-        frq_ids = []  # empty list
-        i_frq = 0
-        for frq in A.frqs:
-            cur.execute(
-                'SELECT id_frq FROM frequencies '
-                'WHERE frequency=?', (np.asscalar(frq),))
-            data = cur.fetchall()
-            if data:  # exist
-                frq_ids.append(data[0][0])
-            else:  # create record
-                cur.execute(
-                    'INSERT INTO frequencies '
-                    '(frequency) values (?)',
-                    (np.asscalar(frq),))
-                frq_ids.append(cur.lastrowid)
-            i_frq += 1
-
         # Fill amplitude table.
-        results = A.SpectralCalculation()
+        results = full['spectral']
 
         # 3. Plot amplitudes for two reflections.
         signals = results['signal']
@@ -115,39 +98,20 @@ if __name__ == '__main__':
             noise)
         ref_count = int(input('Enter a reflections count [0 - default]: ') or '0')
 
-        i_frq = 0
-        for frq_id in frq_ids:
-            cur.execute(
-                'SELECT id_ampl FROM amplitudes '
-                'WHERE ampl_file=? AND ampl_frq=?',
-                (file_id, frq_id))
-            data = cur.fetchall()
-            if data:  # exist
-                pass
-            else:  # create record
-                cur.execute(
-                    'INSERT INTO amplitudes '
-                    '(ampl_file, ampl_frq, '
-                    'power0, power1, Pnoise, '
-                    'h0_eff, h0_std, h1_eff, h1_std, count) '
-                    'VALUES(?,?,?,?,?,?,?,?,?,?)',
-                    (file_id, frq_id,
-                    power0[i_frq],
-                    power1[i_frq],
-                    Pnoise[i_frq],
-                    results['h_eff'][i_frq, 0],
-                    results['h_std'][i_frq, 0],
-                    results['h_eff'][i_frq, 1],
-                    results['h_std'][i_frq, 1],
-                    ref_count))
-
-            i_frq += 1  # next frq number
-
-        # Commit
-        conn.commit()
+        # 2. Save results in sqlite Database.
+        info = {
+            'name': A.name,
+            'time': datetime(*A.time[:6]),
+            'dt': A.dt,
+            'dh': A.heights[1] - A.heights[0],
+            'frqs': A.frqs}
+        writer.addSpectralResults(
+            info, results, power0, power1, Pnoise, ref_count)
+
         # Update Progress Bar
         i_file += 1
 
+    writer.close()
     conn.close()
 
 
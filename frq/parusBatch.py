@@ -2,15 +2,22 @@
 """
 Fill a Parus database by files data from given directory.
 """
+import os
 import os.path as path
 import argparse
-import glob
+import functools
+import multiprocessing
+import time
 
 from datetime import datetime
-import numpy as np
 import sqlite3
 
 import parusFile as pf
+import parusStats as ps
+import parusCatalog as pc
+import parusDB as pdb
+import parusCache as pcache
+import parusMetrics as pm
 #import parusPlot as pplt
 
 
@@ -22,6 +29,71 @@ def createParser():
     parser.add_argument(
         '-f', '--file',
         default='parus.sqlite')
+    parser.add_argument(
+        '-s', '--streaming',
+        action='store_true',
+        help='bounded memory calculation for very long files')
+    parser.add_argument(
+        '-w', '--workers',
+        type=int, default=1,
+        help='number of worker processes')
+    parser.add_argument(
+        '-u', '--unordered',
+        action='store_true',
+        help='save results in order of completion')
+    parser.add_argument(
+        '-r', '--reprocess',
+        action='store_true',
+        help='process files which are in the database already')
+    parser.add_argument(
+        '-b', '--batch',
+        type=int, default=50,
+        help='number of files in one transaction')
+    parser.add_argument(
+        '--wal',
+        action='store_true',
+        help='write-ahead log journal (not for network drives)')
+    parser.add_argument(
+        '--synchronous',
+        default=None, choices=('OFF', 'NORMAL', 'FULL', 'EXTRA'),
+        help='sqlite3 synchronous mode (NORMAL for --wal by default)')
+    parser.add_argument(
+        '--cache',
+        default=pcache.parusCache.defaultDirectory(),
+        help='directory of the cache of results')
+    parser.add_argument(
+        '--no-cache',
+        dest='cache', action='store_const', const=None,
+        help='do not use the cache of results')
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='process new files of the directory until interrupted')
+    parser.add_argument(
+        '--interval',
+        type=float, default=30,
+        help='seconds between checks of the directory in watch mode')
+    parser.add_argument(
+        '--settle',
+        type=float, default=60,
+        help='seconds without changes of a new file before processing')
+    parser.add_argument(
+        '--single',
+        dest='precision', action='store_const',
+        const='single', default='double',
+        help='single precision calculation (half of memory)')
+    parser.add_argument(
+        '-t', '--thereshold',
+        default='std', choices=sorted(ps.theresholdMethods),
+        help='method of theresholds of reflections')
+    parser.add_argument(
+        '--factor',
+        type=float, default=None,
+        help='factor of the thereshold method (its default if not given)')
+    parser.add_argument(
+        '-m', '--metrics',
+        default=None,
+        help='JSON file for timers and counters of processing stages')
 
     return parser
 
@@ -41,9 +113,9 @@ def printProgressBar(
         length      - Optional  : character length of bar (Int)
         fill        - Optional  : bar fill character (Str)
     """
-    percent = (
-        "{0:." + str(decimals) + "f}").format(100 * (iteration / float(total)))
-    filledLength = int(length * iteration // total)
+    fraction = iteration / float(total) if total else 1.0
+    percent = ("{0:." + str(decimals) + "f}").format(100 * fraction)
+    filledLength = int(length * fraction)
     bar = fill * filledLength + '-' * (length - filledLength)
     print('\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix), end='\r')
     # Print New Line on Complete
@@ -51,13 +123,245 @@ def printProgressBar(
         print()
 
 
+def fileOptions(namespace):
+    """Get keyword arguments of parusFile from command line arguments.
+
+    Keyword arguments:
+    namespace -- command line arguments.
+    """
+    return {
+        'precision': namespace.precision,
+        'theresholdMethod': namespace.thereshold,
+        'theresholdFactor': namespace.factor}
+
+
+# caches of results of this process by directories, one cache for all
+# files (the size estimate of the cache is kept between files)
+caches = {}
+
+
+def getCache(directory):
+    """Get the cache of results of this process for the directory.
+
+    Keyword arguments:
+    directory -- directory of the cache (no cache if None).
+    """
+    if not directory:
+        return None
+    if directory not in caches:
+        caches[directory] = pcache.parusCache(directory)
+
+    return caches[directory]
+
+
+def processFile(name, streaming=False, cacheDir=None, metrics=False,
+                **options):
+    """Calculate parameters of the data file.
+
+    Return description of the file and results of HardCalculation.
+    Top level function, so it can be a worker of the process pool.
+
+    Keyword arguments:
+    name -- name of the data file;
+    streaming -- bounded memory calculation;
+    cacheDir -- directory of the cache of results (no cache if None);
+    metrics -- collect metrics of the file (description gets
+    their summary with 'metrics' key);
+    options -- other keyword arguments of parusFile (precision,
+    theresholdMethod, ...).
+    """
+    if metrics:
+        pm.metrics.enable()
+        pm.metrics.reset()
+    with pm.metrics.timer('file'):
+        A = pf.parusFile(name, cache=getCache(cacheDir), **options)
+        info = {
+            'name': A.name,
+            'time': datetime(*A.time[:6]),
+            'dt': A.dt,
+            'dh': A._heights[1] - A._heights[0],
+            'frqs': A.frqs}
+        results = A.HardCalculation(streaming=streaming)
+    if metrics:
+        info['metrics'] = pm.metrics.summary()
+        pm.metrics.reset()
+
+    return info, results
+
+
+def iterResults(names, workers=1, ordered=True, streaming=False,
+                cacheDir=None, metrics=False, **options):
+    """Generate descriptions and results for data files.
+
+    Files are processed by the pool of processes if workers > 1.
+
+    Keyword arguments:
+    names -- names of data files;
+    workers -- number of worker processes;
+    ordered -- generate results in order of names;
+    streaming -- bounded memory calculation;
+    cacheDir -- directory of the cache of results (no cache if None);
+    metrics -- collect metrics of files;
+    options -- other keyword arguments of parusFile.
+    """
+    task = functools.partial(
+        processFile, streaming=streaming, cacheDir=cacheDir,
+        metrics=metrics, **options)
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            imap = pool.imap if ordered else pool.imap_unordered
+            yield from imap(task, names)
+    else:
+        yield from map(task, names)
+
+
+def isComplete(name):
+    """Check that the data file has units and no partial unit at the end.
+
+    Keyword arguments:
+    name -- name of the data file.
+    """
+    try:
+        rec = pf.scanHeader(name)
+    except (OSError, ValueError):  # incomplete header
+        return False
+    datapos = pf.headerDtype.itemsize + 4 * rec.frqs.size
+    unitSize = 4 * rec.count_heights * rec.frqs.size
+
+    return rec.units > 0 and rec.size == datapos + rec.units * unitSize
+
+
+def readyFiles(names, writer, sizes, settle, failed):
+    """Get names of new files which are completely written.
+
+    File is ready if its size is the same as on the previous check,
+    it was not modified for settle seconds and it has complete units
+    only (see isComplete). Other files are checked again.
+
+    Keyword arguments:
+    names -- names of data files;
+    writer -- parusWriter of the database;
+    sizes -- dictionary of sizes of files on the previous check
+    (it is updated);
+    settle -- seconds without modification;
+    failed -- dictionary of (size, mtime) of files with errors
+    (they wait for the next change).
+    """
+    now = time.time()
+    ready = []
+    pending = {}
+    for name in names:
+        if writer.isIngested(path.basename(name)):
+            continue
+        try:
+            st = os.stat(name)
+        except OSError:  # removed
+            continue
+        if failed.get(name) == (st.st_size, st.st_mtime_ns):
+            continue
+        failed.pop(name, None)
+        pending[name] = st.st_size
+        if sizes.get(name) == st.st_size and now - st.st_mtime >= settle:
+            if isComplete(name):
+                ready.append(name)
+    sizes.clear()
+    sizes.update(pending)
+
+    return ready
+
+
+def saveMetrics(files, info):
+    """Add metrics of the processed and saved file to the summaries.
+
+    Metrics of this process (writing in database) are added to
+    metrics of the file and reset.
+
+    Keyword arguments:
+    files -- dictionary of summaries of files by names;
+    info -- description of the file with metrics of processing.
+    """
+    file_metrics = pm.parusMetrics()
+    file_metrics.merge(info['metrics'])
+    file_metrics.merge(pm.metrics.summary())
+    pm.metrics.reset()
+    files[info['name']] = file_metrics.summary()
+
+
+def runSummary(files):
+    """Get metrics of the run from summaries of files and this process.
+
+    Keyword arguments:
+    files -- dictionary of summaries of files by names.
+    """
+    run = pm.parusMetrics()
+    for summary in files.values():
+        run.merge(summary)
+    run.merge(pm.metrics.summary())
+
+    return run
+
+
+def watchDirectory(namespace, writer):
+    """Process new files of the directory until KeyboardInterrupt.
+
+    Directory is polled: its catalog is refreshed when the directory
+    is changed or new files are not complete yet, so old files are not
+    rescanned. Files are processed once, state is kept by the database.
+    Files with errors are skipped until their next change.
+
+    Keyword arguments:
+    namespace -- command line arguments;
+    writer -- parusWriter of the database.
+    """
+    catalog = pc.parusCatalog(namespace.directory)
+    dir_mtime = None
+    sizes = {}
+    failed = {}
+    files = {}  # metrics of files
+    try:
+        while True:
+            mtime = os.stat(namespace.directory).st_mtime_ns
+            if mtime != dir_mtime or sizes:
+                dir_mtime = mtime
+                catalog.refresh()
+                # incomplete headers are new files too (or broken ones)
+                names = readyFiles(
+                    catalog.names() + catalog.unreadable(),
+                    writer, sizes, namespace.settle, failed)
+                for name in names:
+                    try:
+                        info, results = processFile(
+                            name, namespace.streaming, namespace.cache,
+                            bool(namespace.metrics),
+                            **fileOptions(namespace))
+                    except Exception as e:
+                        print('{}: {}'.format(name, e))
+                        try:
+                            st = os.stat(name)
+                        except OSError:
+                            continue
+                        failed[name] = (st.st_size, st.st_mtime_ns)
+                        continue
+                    writer.addHardResults(info, results)
+                    if namespace.metrics:
+                        saveMetrics(files, info)
+                    print('{} {}'.format(datetime.now(), name))
+                    sizes.pop(name, None)
+                writer.commit()
+                if namespace.metrics and names:
+                    runSummary(files).save(namespace.metrics, files)
+            time.sleep(namespace.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        catalog.close()
+
+
 # Проверочная программа
 if __name__ == '__main__':
     # 0. Get working parameters.
     parser = createParser()
     namespace = parser.parse_args()
-    names = glob.glob(path.join(namespace.directory, '*.frq'))
-
     # Create a connection and cursor to your database
     # if file not exist - create empty database
     conn = sqlite3.connect(namespace.file)
@@ -71,9 +375,29 @@ if __name__ == '__main__':
     if not data[0][0]:
         raise ValueError('Database is empty or corrupted.')
 
-    # In sqlite3 foreign key constraints are disabled by default
-    # for performance reasons. PRAGMA statement enables them.
-    cur.execute("PRAGMA foreign_keys = ON")
+    # Metrics of writing in database are collected by this process.
+    if namespace.metrics:
+        pm.metrics.enable()
+    files = {}
+
+    # Bulk writer of results (foreign keys are enabled by it).
+    writer = pdb.parusWriter(
+        conn, batchSize=namespace.batch, wal=namespace.wal,
+        synchronous=namespace.synchronous)
+    if namespace.watch:
+        watchDirectory(namespace, writer)
+        writer.close()
+        conn.close()
+        raise SystemExit
+
+    catalog = pc.parusCatalog(namespace.directory)
+    catalog.refresh()
+    names = catalog.names()
+    catalog.close()
+    if not namespace.reprocess:
+        names = [
+            name for name in names
+            if not writer.isIngested(path.basename(name))]
 
     i_file = 0
     n_files = len(names)
@@ -81,88 +405,31 @@ if __name__ == '__main__':
     printProgressBar(
         i_file, n_files,
         prefix='Progress:', suffix='Complete', length=50)
-    for name in names:
-        # 1. Parsing data and collect information.
-        A = pf.parusFile(name)
-
-        # 2. Save results in sqlite Database.
-        # Fill file table.
-        ftime = datetime(*A.time[:6])
-        cur.execute(
-            'SELECT id_file FROM files WHERE filename=?', (A.name,))
-        data = cur.fetchall()
-        if data:  # exist
-            file_id = data[0][0]
-        else:  # create record
-            cur.execute(
-                'insert into files '
-                '(filename, time, dt, dh) values (?,?,?,?)',
-                (A.name, ftime, A.dt, A._heights[1] - A._heights[0]))
-            file_id = cur.lastrowid
-
-        # Fill frequencies table.
-        frq_ids = []  # empty list
-        i_frq = 0
-        for frq in A.frqs:
-            cur.execute(
-                'SELECT id_frq FROM frequencies '
-                'WHERE frequency=?', (np.asscalar(frq),))
-            data = cur.fetchall()
-            if data:  # exist
-                frq_ids.append(data[0][0])
-            else:  # create record
-                cur.execute(
-                    'INSERT INTO frequencies '
-                    '(frequency) values (?)',
-                    (np.asscalar(frq),))
-                frq_ids.append(cur.lastrowid)
-            i_frq += 1
-
-        # Fill amplitude table.
-        results = A.HardCalculation()
-        i_frq = 0
-        for frq_id in frq_ids:
-            cur.execute(
-                'SELECT id_ampl FROM amplitudes '
-                'WHERE ampl_file=? AND ampl_frq=?',
-                (file_id, frq_id))
-            data = cur.fetchall()
-            if data:  # exist
-                pass
-            else:  # create record
-                shape = results['A_eff'].shape
-                for i_ref in range(shape[1]):  # by reflection
-                    if np.isnan(results['A_eff'][i_frq, i_ref]):
-                        break
-                    if results['A_std'][i_frq, i_ref] == 0:
-                        break
-                    cur.execute(
-                        'INSERT INTO amplitudes '
-                        '(ampl_file, ampl_frq, number, '
-                        'a_eff, a_std, n_std, h_eff, h_std ) '
-                        'VALUES(?,?,?,?,?,?,?,?)',
-                        (file_id, frq_id, i_ref,
-                        results['A_eff'][i_frq, i_ref],
-                        results['A_std'][i_frq, i_ref],
-                        results['n_std'][i_frq, i_ref],
-                        results['h_eff'][i_frq, i_ref],
-                        results['h_std'][i_frq, i_ref]))
-
-            if results['counts'][i_frq]:
-                 cur.execute(
-                    'UPDATE amplitudes SET L_mean = ?, counts = ? '
-                    'WHERE ampl_file = ? AND ampl_frq = ? AND number = 1',
-                    (results['L_mean'][i_frq],
-                    results['counts'][i_frq],
-                    file_id, frq_id))
-            i_frq += 1  # next frq number
-
-        # Commit
-        conn.commit()
+    # 1. Parsing data and collect information (by worker processes).
+    outputs = iterResults(
+        names,
+        workers=namespace.workers,
+        ordered=not namespace.unordered,
+        streaming=namespace.streaming,
+        cacheDir=namespace.cache,
+        metrics=bool(namespace.metrics),
+        **fileOptions(namespace))
+    for info, results in outputs:
+        # 2. Save results in sqlite Database (by this process only).
+        writer.addHardResults(info, results)
+        if namespace.metrics:
+            saveMetrics(files, info)
+
         # Update Progress Bar
         i_file += 1
         printProgressBar(
             i_file, n_files,
             prefix='Progress:', suffix='Complete', length=50)
 
+    writer.close()
     conn.close()
+
+    if namespace.metrics:
+        run = runSummary(files)
+        run.save(namespace.metrics, files)
+        print(run.report())
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of Parus data processing on synthetic files.
+
+Results (time, throughput and peak memory of every benchmark) are saved
+in JSON file, so runs can be compared with each other.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+import parusFile as pf
+import parusDB as pdb
+import parusSynth as syn
+
+# tables of parusWriter for hard calculation results
+hardSchema = (
+    'CREATE TABLE files (id_file INTEGER PRIMARY KEY NOT NULL,'
+    ' filename VARCHAR(25) NOT NULL, time TIMESTAMP NOT NULL,'
+    ' dt REAL DEFAULT(0), dh REAL DEFAULT(0), notes VARCHAR(50));'
+    'CREATE TABLE frequencies (id_frq INTEGER PRIMARY KEY NOT NULL,'
+    ' frequency INTEGER NOT NULL, notes VARCHAR(50));'
+    'CREATE TABLE amplitudes (id_ampl INTEGER PRIMARY KEY NOT NULL,'
+    ' ampl_file INTEGER NOT NULL REFERENCES files(id_file),'
+    ' ampl_frq INTEGER NOT NULL REFERENCES frequencies(id_frq),'
+    ' number INTEGER, a_eff REAL, a_std REAL, n_std REAL, h_eff REAL,'
+    ' h_std REAL, L_mean REAL, counts INTEGER, L REAL, B REAL, H REAL);')
+
+
+def createParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-o', '--output',
+        default='parus_bench_{}.json'.format(
+            datetime.now().strftime('%Y%m%d_%H%M%S')),
+        help='JSON file of results')
+    parser.add_argument(
+        '-d', '--directory',
+        default=None,
+        help='directory of synthetic files (temporary if not given)')
+    parser.add_argument(
+        '-v', '--versions',
+        type=int, nargs='+', default=[1], choices=(0, 1, 2),
+        help='versions of .frq files')
+    parser.add_argument(
+        '-n', '--frequencies',
+        type=int, default=5,
+        help='number of frequencies')
+    parser.add_argument(
+        '-H', '--heights',
+        type=int, default=256,
+        help='number of heights (version 1)')
+    parser.add_argument(
+        '-u', '--units',
+        type=int, default=2000,
+        help='number of units')
+    parser.add_argument(
+        '-r', '--repeat',
+        type=int, default=3,
+        help='number of runs (the best time is taken)')
+    parser.add_argument(
+        '-b', '--benchmarks',
+        nargs='+', default=None,
+        help='names of benchmarks to run (all if not given)')
+    parser.add_argument(
+        '-c', '--compare',
+        default=None,
+        help='JSON file of previous run for comparison')
+
+    return parser
+
+
+def measure(func, repeat=3):
+    """Get the best time of runs and peak of allocated memory.
+
+    Memory is traced by the separate run, so tracing does not change
+    the time.
+
+    Keyword arguments:
+    func -- function without arguments;
+    repeat -- number of timed runs.
+    """
+    seconds = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(seconds), peak
+
+
+def frqBenchmarks(fname):
+    """Get benchmarks of the .frq file.
+
+    Return list of (name, function, count of units, bytes).
+
+    Keyword arguments:
+    fname -- name of the data file.
+    """
+    A = pf.parusFile(fname)
+    units = A.units
+    size = A._mmap.nbytes
+    ave_means, _, _, _ = A.getAveragedMeans()
+
+    def unitsLoop():
+        B = pf.parusFile(fname)
+        for i in range(B.units):
+            B.getUnit(i)
+
+    def method(name, *args, **options):
+        def run():
+            B = pf.parusFile(fname, **options)
+            getattr(B, name)(*args)
+        return run
+
+    return [
+        ('getUnit', unitsLoop, units, size),
+        ('getAveragedMeans', method('getAveragedMeans'), units, size),
+        ('getSigma', method('getSigma', ave_means), units, size),
+        ('HardCalculation', method('HardCalculation'), units, size),
+        ('HardCalculation(streaming)',
+            method('HardCalculation', True), units, size),
+        ('HardCalculation(single)',
+            method('HardCalculation', False, precision='single'),
+            units, size),
+        ('HardCalculation(iqr)',
+            method('HardCalculation', False, theresholdMethod='iqr'),
+            units, size),
+        ('SpectralCalculation', method('SpectralCalculation'), units, size),
+        ('FullCalculation', method('FullCalculation'), units, size)]
+
+
+def ingestBenchmark(fname, files=200):
+    """Get benchmark of saving hard calculation results in database.
+
+    Return (name, function, count of saved rows, None). Data files are
+    not read by the benchmark, so it has no bytes for MB/s.
+
+    Keyword arguments:
+    fname -- name of the data file;
+    files -- number of saved copies of the file results.
+    """
+    A = pf.parusFile(fname)
+    results = A.HardCalculation()
+    info = {
+        'time': datetime(*A.time[:6]),
+        'dt': A.dt,
+        'dh': A._heights[1] - A._heights[0],
+        'frqs': A.frqs}
+
+    def save(con, files):
+        con.executescript(hardSchema)
+        writer = pdb.parusWriter(con)
+        for i in range(files):
+            info['name'] = '{:06d}.frq'.format(i)
+            writer.addHardResults(info, results)
+        writer.close()
+
+    def run():
+        con = sqlite3.connect(':memory:')
+        save(con, files)
+        con.close()
+
+    # every file gives the same rows of amplitudes
+    con = sqlite3.connect(':memory:')
+    save(con, 1)
+    rows, = con.execute('SELECT count(*) FROM amplitudes').fetchone()
+    con.close()
+
+    return 'parusWriter.addHardResults', run, files * rows, None
+
+
+def ionBenchmark(fname):
+    """Get benchmark of ionogram reading.
+
+    Return (name, function, count of lines, bytes) or None if
+    ion/iview3.py can not be imported (it needs matplotlib).
+
+    Keyword arguments:
+    fname -- name of the .ion file.
+    """
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'ion'))
+    try:
+        import iview3
+    except ImportError:
+        return None
+    lines = iview3.readDataFile(fname)['frqs'].size
+
+    def run():
+        iview3.readDataFile(fname)
+
+    return 'readDataFile', run, lines, os.path.getsize(fname)
+
+
+def runBenchmarks(namespace, directory):
+    """Run benchmarks on synthetic files of the directory.
+
+    Return list of dictionaries with results.
+
+    Keyword arguments:
+    namespace -- command line arguments;
+    directory -- directory for synthetic files.
+    """
+    frqs = 1600 + 200 * np.arange(namespace.frequencies)
+    benchmarks = []
+    for version in namespace.versions:
+        fname = os.path.join(directory, 'synth_v{}.frq'.format(version))
+        syn.writeFrq(
+            fname, version=version, frqs=frqs,
+            count_height=namespace.heights, units=namespace.units)
+        for name, func, count, size in frqBenchmarks(fname):
+            benchmarks.append(
+                (name, 'units', version, fname, func, count, size))
+        name, func, count, size = ingestBenchmark(fname)
+        benchmarks.append(
+            (name, 'rows', version, fname, func, count, size))
+
+    fname = os.path.join(directory, 'synth.ion')
+    syn.writeIon(fname)
+    ion = ionBenchmark(fname)
+    if ion is None:
+        print('readDataFile is skipped: ion/iview3.py can not be imported.')
+    else:
+        name, func, count, size = ion
+        benchmarks.append((name, 'lines', None, fname, func, count, size))
+
+    results = []
+    for name, counted, version, fname, func, count, size in benchmarks:
+        if namespace.benchmarks and name not in namespace.benchmarks:
+            continue
+        seconds, peak = measure(func, namespace.repeat)
+        mb_per_s = size / seconds / 2**20 if size else None
+        results.append({
+            'name': name,
+            'version': version,
+            'file': os.path.basename(fname),
+            'count': count,
+            'counted': counted,
+            'bytes': size,
+            'seconds': seconds,
+            'rate': count / seconds,
+            'mb_per_s': mb_per_s,
+            'peak_mb': peak / 2**20})
+        print('{:30} v{} {:10.4f} s {:12.1f} {}/s {:>14} '
+              '{:9.1f} MB peak'.format(
+                  name, version, seconds, count / seconds, counted,
+                  '' if mb_per_s is None else '{:9.1f} MB/s'.format(
+                      mb_per_s),
+                  peak / 2**20))
+
+    return results
+
+
+def compareRuns(results, fname):
+    """Print speedup of results relative to the previous run.
+
+    Keyword arguments:
+    results -- list of results of this run;
+    fname -- JSON file of the previous run.
+    """
+    with open(fname) as f:
+        previous = json.load(f)
+    old = dict(
+        ((item['name'], item['version']), item)
+        for item in previous['results'])
+    print('Comparison with {}:'.format(fname))
+    for item in results:
+        before = old.get((item['name'], item['version']))
+        if before is None:
+            continue
+        print('{:30} v{} speedup {:6.2f}, memory {:6.2f}'.format(
+            item['name'], item['version'],
+            before['seconds'] / item['seconds'],
+            item['peak_mb'] / max(before['peak_mb'], 1e-9)))
+
+
+if __name__ == '__main__':
+    parser = createParser()
+    namespace = parser.parse_args()
+
+    if namespace.directory is None:
+        with tempfile.TemporaryDirectory() as directory:
+            results = runBenchmarks(namespace, directory)
+    else:
+        os.makedirs(namespace.directory, exist_ok=True)
+        results = runBenchmarks(namespace, namespace.directory)
+
+    output = {
+        'time': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'arguments': vars(namespace),
+        'results': results}
+    with open(namespace.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print('Results are saved to {}'.format(namespace.output))
+
+    if namespace.compare:
+        compareRuns(results, namespace.compare)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of results of data files analyses.
+"""
+import functools
+import hashlib
+import inspect
+import os
+import tempfile
+
+import numpy as np
+
+
+def cachedResult(version):
+    """Decorator of parusFile analysis methods with cached results.
+
+    Result is taken from the cache of the object (if it is set) by the key
+    of the file identity, analysis configuration, method name and
+    arguments and algorithm version. Arguments must be simple values,
+    defaults are applied, so equal calls have the same key. The key of
+    the call is given by the getKey attribute of the decorated method.
+
+    Keyword arguments:
+    version -- version of the algorithm (change it with the algorithm).
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def getKey(self, *args, **kwargs):
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = list(bound.arguments.items())[1:]  # without self
+            return self._cache.getKey(
+                self._file.name,
+                (method.__name__, version, arguments,
+                 self.getConfiguration()))
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, '_cache', None)
+            if cache is None:
+                return method(self, *args, **kwargs)
+
+            key = getKey(self, *args, **kwargs)
+            result = cache.load(key)
+            if result is None:
+                result = method(self, *args, **kwargs)
+                cache.save(key, result)
+
+            return result
+
+        wrapper.getKey = getKey
+        return wrapper
+
+    return decorator
+
+
+class parusCache(object):
+    """Class for on-disk cache of analyses results.
+
+    Entries are npz files named by the hash of the key, the least
+    recently used entries are removed when size of the cache exceeds
+    the limit.
+    """
+
+    # bytes of the file hashed at the begin, middle and end
+    chunkSize = 1 << 16
+
+    def __init__(self, directory=None, maxSize=1 << 30):
+        """Open (or create) cache directory.
+
+        Keyword arguments:
+        directory -- directory of the cache (defaultDirectory() if None);
+        maxSize -- maximal size of the cache, bytes.
+        """
+        super().__init__()
+        if directory is None:
+            directory = self.defaultDirectory()
+        os.makedirs(directory, exist_ok=True)
+        self._directory = directory
+        self._maxSize = maxSize
+        self._size = None  # unknown before the first eviction
+        self._identities = {}
+
+    @staticmethod
+    def defaultDirectory():
+        "Get default directory of the cache."
+        return os.path.join(os.path.expanduser('~'), '.parus_cache')
+
+    # property BEGIN
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def maxSize(self):
+        return self._maxSize
+    # property END
+
+    def getIdentity(self, filename):
+        """Get identity of the file: size, mtime and fast content hash.
+
+        Keyword arguments:
+        filename -- name of the data file.
+        """
+        st = os.stat(filename)
+        stamp = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+        identity = self._identities.get(stamp)
+        if identity is None:
+            h = hashlib.blake2b(digest_size=16)
+            with open(filename, 'rb') as f:
+                for pos in (0, st.st_size // 2, st.st_size - self.chunkSize):
+                    f.seek(max(pos, 0))
+                    h.update(f.read(self.chunkSize))
+            identity = '{}:{}:{}'.format(
+                st.st_size, st.st_mtime_ns, h.hexdigest())
+            self._identities[stamp] = identity
+
+        return identity
+
+    def getKey(self, filename, params):
+        """Get key of the cache entry.
+
+        Keyword arguments:
+        filename -- name of the data file;
+        params -- simple values which define the result.
+        """
+        h = hashlib.sha1(self.getIdentity(filename).encode())
+        h.update(repr(params).encode())
+
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key + '.npz')
+
+    def load(self, key):
+        """Get cached result or None if it does not exist.
+
+        Keyword arguments:
+        key -- key of the cache entry (see getKey).
+        """
+        name = self._path(key)
+        try:
+            with np.load(name, allow_pickle=False) as data:
+                arrays = dict((k, data[k]) for k in data.files)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(name)  # mark as recently used
+        except OSError:
+            pass
+
+        kind = str(arrays.pop('__kind__'))
+        if kind == 'tuple':
+            return tuple(arrays['item{}'.format(i)] for i in range(len(arrays)))
+        elif kind == 'array':
+            return arrays['item0']
+        else:
+            return arrays
+
+    def save(self, key, result):
+        """Save result (dict or tuple of arrays or array) in the cache.
+
+        Keyword arguments:
+        key -- key of the cache entry (see getKey);
+        result -- result of the analysis.
+        """
+        if isinstance(result, dict):
+            arrays = dict(result)
+            kind = 'dict'
+        elif isinstance(result, tuple):
+            arrays = dict(
+                ('item{}'.format(i), item) for i, item in enumerate(result))
+            kind = 'tuple'
+        else:
+            arrays = {'item0': result}
+            kind = 'array'
+
+        name = self._path(key)
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        # atomic replace, so parallel processes see full entries only
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(name))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, __kind__=np.array(kind), **arrays)
+            os.replace(tmp, name)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        if self._size is not None:
+            self._size += os.path.getsize(name)
+        if self._size is None or self._size > self._maxSize:
+            self.evict()
+
+    def evict(self):
+        "Remove least recently used entries to fit the size limit."
+        entries = []
+        for root, dirs, files in os.walk(self._directory):
+            for fname in files:
+                if not fname.endswith('.npz'):
+                    continue
+                name = os.path.join(root, fname)
+                try:
+                    st = os.stat(name)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        for mtime, fsize, name in entries:
+            if size <= self._maxSize:
+                break
+            try:
+                os.remove(name)
+            except OSError:
+                continue
+            size -= fsize
+        self._size = size
+
+    def clear(self):
+        "Remove all entries."
+        maxSize = self._maxSize
+        self._maxSize = 0
+        self.evict()
+        self._maxSize = maxSize
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent catalog of Parus data files of a directory.
+"""
+from datetime import datetime
+import fnmatch
+import os
+import sqlite3
+
+import numpy as np
+import parusFile as pf
+
+
+class parusCatalog(object):
+    """Class for sidecar sqlite3 catalog of data files headers.
+
+    Only new and changed (by size or mtime) files are read on refresh,
+    so opening of a big directory costs one listing of the directory.
+    """
+
+    catalogName = '.parus_catalog.sqlite'
+
+    def __init__(self, directory, fileName=None, pattern='*.frq'):
+        """Open (or create) catalog of the directory.
+
+        Keyword arguments:
+        directory -- directory with data files;
+        fileName -- catalog file (sidecar file in directory if None);
+        pattern -- shell pattern of names of data files.
+        """
+        super().__init__()
+        self._directory = directory
+        self._pattern = pattern
+        if fileName is None:
+            fileName = os.path.join(directory, self.catalogName)
+        try:
+            self._con = sqlite3.connect(fileName)
+            self.createTables()
+        except sqlite3.OperationalError:
+            # read-only directory, catalog lives for this session only
+            fileName = ':memory:'
+            self._con = sqlite3.connect(fileName)
+            self.createTables()
+        self._filename = fileName
+
+    def createTables(self):
+        "Create catalog tables if not exist."
+        self._con.executescript(
+            'CREATE TABLE IF NOT EXISTS catalog ('
+            ' name TEXT PRIMARY KEY NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime INTEGER NOT NULL,'
+            ' version INTEGER,'
+            ' time TEXT,'
+            ' dt REAL,'
+            ' frqs BLOB,'
+            ' height_min INTEGER,'
+            ' height_max INTEGER,'
+            ' height_step INTEGER,'
+            ' count_height INTEGER,'
+            ' count_heights INTEGER,'
+            ' units INTEGER);'
+            'CREATE INDEX IF NOT EXISTS catalog_time ON catalog (time);'
+            'CREATE TABLE IF NOT EXISTS catalog_frqs ('
+            ' frequency INTEGER NOT NULL,'
+            ' name TEXT NOT NULL,'
+            ' PRIMARY KEY (frequency, name)) WITHOUT ROWID;')
+        self._con.commit()
+
+    # property BEGIN
+    @property
+    def directory(self):
+        return self._directory
+
+    @property
+    def filename(self):
+        return self._filename
+    # property END
+
+    def refresh(self, workers=8):
+        """Synchronize catalog with the directory.
+
+        Return number of read headers.
+
+        Keyword arguments:
+        workers -- number of threads for reading of headers.
+        """
+        known = dict(
+            (name, (size, mtime)) for name, size, mtime in
+            self._con.execute('SELECT name, size, mtime FROM catalog'))
+
+        changed = []
+        present = set()
+        with os.scandir(self._directory) as it:
+            for entry in it:
+                if not fnmatch.fnmatch(entry.name, self._pattern):
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                present.add(entry.name)
+                if known.get(entry.name) != (st.st_size, st.st_mtime_ns):
+                    changed.append((entry.name, st.st_size, st.st_mtime_ns))
+
+        removed = [(name,) for name in known if name not in present]
+        self._con.executemany(
+            'DELETE FROM catalog WHERE name=?', removed)
+        self._con.executemany(
+            'DELETE FROM catalog_frqs WHERE name=?', removed)
+
+        paths = [os.path.join(self._directory, name) for name, _, _ in changed]
+        records = pf.scanHeaders(paths, workers, True) if paths else []
+        rows = []
+        frq_rows = []
+        for (name, size, mtime), rec in zip(changed, records):
+            if rec is None:  # unreadable file, wait for its change
+                rows.append((name, size, mtime) + (None,) * 10)
+                continue
+            rows.append((
+                name, size, mtime, rec.version,
+                datetime(*rec.time[:6]).strftime('%Y-%m-%d %H:%M:%S'),
+                rec.dt, rec.frqs.astype(np.uint32).tobytes(),
+                rec.height_min, rec.height_max, rec.height_step,
+                rec.count_height, rec.count_heights, rec.units))
+            frq_rows.extend((int(frq), name) for frq in rec.frqs)
+
+        self._con.executemany(
+            'DELETE FROM catalog_frqs WHERE name=?',
+            [(name,) for name, _, _ in changed])
+        self._con.executemany(
+            'INSERT OR REPLACE INTO catalog VALUES '
+            '(?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+        self._con.executemany(
+            'INSERT OR IGNORE INTO catalog_frqs VALUES (?,?)', frq_rows)
+        self._con.commit()
+
+        return len(rows)
+
+    def _select(self, columns, time_from=None, time_to=None, frqs=None):
+        """Execute SELECT of catalog rows for given filters."""
+        where = ['version IS NOT NULL']
+        params = []
+        if time_from is not None:
+            where.append('time >= ?')
+            params.append(time_from.strftime('%Y-%m-%d %H:%M:%S'))
+        if time_to is not None:
+            where.append('time <= ?')
+            params.append(time_to.strftime('%Y-%m-%d %H:%M:%S'))
+        if frqs is not None:
+            frqs = [int(frq) for frq in frqs]
+            where.append(
+                'name IN (SELECT name FROM catalog_frqs '
+                'WHERE frequency IN ({}))'.format(','.join('?' * len(frqs))))
+            params.extend(frqs)
+
+        text = 'SELECT {} FROM catalog WHERE {} ORDER BY time, name'.format(
+            columns, ' AND '.join(where))
+
+        return self._con.execute(text, params)
+
+    def names(self, time_from=None, time_to=None, frqs=None):
+        """Get full names of data files sorted by time.
+
+        Keyword arguments:
+        time_from, time_to -- datetime bounds of sounding beginning;
+        frqs -- list of frequencies (files with any of them).
+        """
+        cur = self._select('name', time_from, time_to, frqs)
+        return [os.path.join(self._directory, name) for name, in cur]
+
+    def records(self, time_from=None, time_to=None, frqs=None):
+        """Get headers descriptions (pf.headerRecord) sorted by time.
+
+        Keyword arguments are the same as for names.
+        """
+        cur = self._select(
+            'name, size, mtime, version, time, dt, frqs, '
+            'height_min, height_max, height_step, count_height, '
+            'count_heights, units',
+            time_from, time_to, frqs)
+
+        records = []
+        for row in cur:
+            tm = datetime.strptime(row[4], '%Y-%m-%d %H:%M:%S')
+            records.append(pf.headerRecord(
+                name=row[0],
+                path=os.path.join(self._directory, row[0]),
+                size=row[1],
+                mtime=row[2] / 1e9,
+                version=row[3],
+                time=tm.timetuple(),
+                dt=row[5],
+                frqs=np.frombuffer(row[6], np.uint32),
+                height_min=row[7],
+                height_max=row[8],
+                height_step=row[9],
+                count_height=row[10],
+                count_heights=row[11],
+                units=row[12]))
+
+        return records
+
+    def unreadable(self):
+        "Get full names of files with unreadable (incomplete) headers."
+        cur = self._con.execute(
+            'SELECT name FROM catalog WHERE version IS NULL ORDER BY name')
+        return [os.path.join(self._directory, name) for name, in cur]
+
+    def frequencies(self):
+        "Get sorted unique frequencies of all data files."
+        cur = self._con.execute(
+            'SELECT DISTINCT frequency FROM catalog_frqs ORDER BY frequency')
+        return np.array([frq for frq, in cur], dtype=np.uint32)
+
+    def close(self):
+        "Close catalog connection."
+
+        self._con.close()
@@ -5,15 +5,98 @@ Work with database SQLite3.
 from datetime import datetime
 import numpy as np
 import sqlite3
+import struct
+import zlib
 import io
+import itertools
+
+import parusMetrics as pm
+
+# BLOB of array: magic, flags, ndim, length of dtype string, dtype string,
+# shape (uint64 each), raw C-ordered data (zlib stream if compressed)
+arrayMagic = b'\x93PRS'
+arrayHeader = struct.Struct('<4sBBB')
+arrayCompressed = 1
+
+
+def encodeArray(arr, compressSize=None, level=1):
+    """Pack array into compact BLOB.
+
+    Keyword arguments:
+    arr -- numpy array (not of objects), structured arrays are saved
+    by np.save;
+    compressSize -- compress data not less than this size, bytes
+    (no compression if None);
+    level -- zlib compression level.
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.hasobject:
+        raise ValueError('Arrays of objects can not be saved.')
+
+    # fields are lost by the dtype string, np.save keeps them
+    if arr.dtype.names is not None or arr.dtype.subdtype is not None:
+        out = io.BytesIO()
+        np.save(out, arr, allow_pickle=False)
+        return sqlite3.Binary(out.getvalue())
+
+    if not arr.flags.c_contiguous:
+        arr = arr.copy(order='C')
+    descr = arr.dtype.str.encode('ascii')
+    flags = 0
+    # bytes view, datetime64 has no buffer protocol
+    data = arr.reshape(-1).view(np.uint8) if arr.size else b''
+    if compressSize is not None and arr.nbytes >= compressSize:
+        packed = zlib.compress(data, level)
+        if len(packed) < arr.nbytes:
+            data = packed
+            flags |= arrayCompressed
+
+    head = arrayHeader.pack(arrayMagic, flags, arr.ndim, len(descr))
+    shape = struct.pack('<{}Q'.format(arr.ndim), *arr.shape)
+
+    return sqlite3.Binary(b''.join((head, descr, shape, data)))
+
+
+def decodeArray(blob):
+    """Unpack array from BLOB of encodeArray or np.save.
+
+    Not compressed data is not copied, so the array is read-only.
+
+    Keyword arguments:
+    blob -- bytes from the database.
+    """
+    if blob[:len(arrayMagic)] != arrayMagic:
+        return np.load(io.BytesIO(blob))
+
+    magic, flags, ndim, n_descr = arrayHeader.unpack_from(blob)
+    pos = arrayHeader.size
+    dtype = np.dtype(bytes(blob[pos:pos + n_descr]).decode('ascii'))
+    pos += n_descr
+    shape = struct.unpack_from('<{}Q'.format(ndim), blob, pos)
+    pos += 8 * ndim
+
+    if flags & arrayCompressed:
+        arr = np.frombuffer(zlib.decompress(blob[pos:]), dtype)
+    else:
+        arr = np.frombuffer(blob, dtype, offset=pos)
+
+    return arr.reshape(shape)
 
 
 class parusDB(object):
     "Class for work with sqlite3 database for Parus data."
 
-    def __init__(self, fileName='parus.sqlite'):
+    def __init__(self, fileName='parus.sqlite', compressSize=None):
+        """Open database.
+
+        Keyword arguments:
+        fileName -- name of the database file;
+        compressSize -- compress arrays not less than this size, bytes
+        (no compression if None).
+        """
         super().__init__()
         self._filename = fileName
+        self._compressSize = compressSize
         self.customization()
         self._con = sqlite3.connect(
             self._filename,
@@ -21,23 +104,17 @@ class parusDB(object):
         self._cur = self._con.cursor()
 
     def adapt_array(self, arr):
-        """
-        http://stackoverflow.com/a/31312102/190597 (SoulNibbler)
-        """
-        out = io.BytesIO()
-        np.save(out, arr)
-        out.seek(0)
-        return sqlite3.Binary(out.read())
+        "Pack np.array into BLOB (see encodeArray)."
+        return encodeArray(arr, self._compressSize)
 
     def convert_array(self, text):
-        out = io.BytesIO(text)
-        out.seek(0)
-        return np.load(out)
+        "Unpack np.array from BLOB (new or np.save format)."
+        return decodeArray(text)
 
     def customization(self):
-        # Converts np.array to TEXT when inserting
+        # Converts np.array to BLOB when inserting
         sqlite3.register_adapter(np.ndarray, self.adapt_array)
-        # Converts TEXT to np.array when selecting
+        # Converts BLOB to np.array when selecting
         sqlite3.register_converter("array", self.convert_array)
 
     def executeSELECT(self, text):
@@ -53,14 +130,370 @@ class parusDB(object):
                         (name, tm, dt, heights, amplitudes))
         self._con.commit()
 
-    def getResults(self):
-        # And retrieve the array directly from sqlite as a NumPy array:
-        # cur.execute("select arr from test")
-        # data = cur.fetchone()[0]
-        pass
+    # key columns of query results
+    keyColumns = ('time', 'ampl_file', 'frequency', 'number')
+    idColumns = ('id_ampl', 'ampl_frq')
+    # value of NULL in query (cursor gives only numbers to np.fromiter)
+    nullValue = -np.finfo(np.float64).max
+
+    def getValueColumns(self):
+        "Get names of value columns of amplitudes table."
+        cur = self._con.execute('PRAGMA table_info(amplitudes)')
+        return [row[1] for row in cur
+                if row[1] not in self.keyColumns + self.idColumns
+                and row[2].upper() in ('REAL', 'INTEGER')]
+
+    def hasNumbers(self):
+        """Check number column of amplitudes table.
+
+        Reflections are numbered in the table of hard calculation
+        results, the table of spectral results has no number column.
+        """
+        cur = self._con.execute('PRAGMA table_info(amplitudes)')
+        return any(row[1] == 'number' for row in cur)
+
+    def checkColumns(self, columns=None):
+        """Check names of value columns, get all of them if None."""
+        known = self.getValueColumns()
+        if columns is None:
+            return known
+        unknown = [name for name in columns if name not in known]
+        if unknown:
+            raise ValueError('Unknown columns: {}.'.format(unknown))
+
+        return list(columns)
+
+    def getResultsDtype(self, columns):
+        """Get dtype of records of query results."""
+        return np.dtype(
+            [('time', 'M8[s]'), ('ampl_file', np.int64),
+             ('frequency', np.int64), ('number', np.int64)] +
+            [(name, np.float64) for name in columns])
+
+    def getLookup(self, text, params=()):
+        """Get array of values indexed by ids from query of (id, value)."""
+        pairs = np.array(
+            self._con.execute(text, params).fetchall(), dtype=np.int64)
+        lookup = np.zeros(
+            pairs[:, 0].max() + 1 if len(pairs) else 1, dtype=np.int64)
+        if len(pairs):
+            lookup[pairs[:, 0]] = pairs[:, 1]
+
+        return lookup
+
+    def iterResults(self, columns=None, time_from=None, time_to=None,
+                    frqs=None, numbers=None, chunkSize=10000):
+        """Iterate over chunks of amplitudes records as structured arrays.
+
+        Records follow the table order. Fields are time (datetime64[s]),
+        ampl_file, frequency, number (-1 if NULL or the table has no
+        number column) and float columns (NaN if NULL). Times and
+        frequencies are taken from small lookup arrays, so the big table
+        is read without joins.
+
+        Keyword arguments:
+        columns -- names of value columns (all if None);
+        time_from, time_to -- datetime bounds of files time;
+        frqs -- list of frequencies;
+        numbers -- list of reflection numbers (only for the table
+        with number column);
+        chunkSize -- number of records fetched at once.
+        """
+        columns = self.checkColumns(columns)
+        dtype = self.getResultsDtype(columns)
+        hasNumbers = self.hasNumbers()
+        if numbers is not None and not hasNumbers:
+            raise ValueError(
+                'Amplitudes table has no number column.')
+
+        file_where = []
+        file_params = []
+        if time_from is not None:
+            file_where.append('time >= ?')
+            file_params.append(time_from.strftime('%Y-%m-%d %H:%M:%S'))
+        if time_to is not None:
+            file_where.append('time <= ?')
+            file_params.append(time_to.strftime('%Y-%m-%d %H:%M:%S'))
+        file_where = ' AND '.join(file_where) or '1'
+        times = self.getLookup(
+            "SELECT id_file, CAST(strftime('%s', time) AS INTEGER) "
+            "FROM files WHERE {}".format(file_where), file_params)
+        frequencies = self.getLookup(
+            'SELECT id_frq, frequency FROM frequencies')
+
+        where = []
+        params = [self.nullValue]
+        if file_params:
+            where.append(
+                'ampl_file IN (SELECT id_file FROM files WHERE {})'.format(
+                    file_where))
+            params.extend(file_params)
+        if frqs is not None:
+            frqs = [int(frq) for frq in frqs]
+            where.append(
+                'ampl_frq IN (SELECT id_frq FROM frequencies '
+                'WHERE frequency IN ({}))'.format(','.join('?' * len(frqs))))
+            params.extend(frqs)
+        if numbers is not None:
+            numbers = [int(number) for number in numbers]
+            where.append('number IN ({})'.format(
+                ','.join('?' * len(numbers))))
+            params.extend(numbers)
+
+        text = (
+            'WITH null_value(x) AS (SELECT ?) '
+            'SELECT ampl_file, ampl_frq, {}{} '
+            'FROM amplitudes, null_value{}').format(
+                'IFNULL(number, -1)' if hasNumbers else '-1',
+                ''.join(', IFNULL({}, x)'.format(name) for name in columns),
+                ' WHERE {}'.format(' AND '.join(where)) if where else '')
+
+        n_cols = len(dtype.names) - 1
+        cur = self._con.execute(text, params)
+        try:
+            while True:
+                rows = cur.fetchmany(chunkSize)
+                if not rows:
+                    break
+                values = np.fromiter(
+                    itertools.chain.from_iterable(rows),
+                    dtype=np.float64, count=len(rows) * n_cols)
+                values = values.reshape(len(rows), n_cols)
+                values[values == self.nullValue] = np.nan
+
+                chunk = np.empty(len(rows), dtype=dtype)
+                file_ids = values[:, 0].astype(np.int64)
+                chunk['time'] = times[file_ids]
+                chunk['ampl_file'] = file_ids
+                chunk['frequency'] = frequencies[values[:, 1].astype(np.int64)]
+                chunk['number'] = values[:, 2]
+                for i, name in enumerate(columns, 3):
+                    chunk[name] = values[:, i]
+                yield chunk
+        finally:
+            cur.close()
+
+    def getResults(self, columns=None, time_from=None, time_to=None,
+                   frqs=None, numbers=None, asDict=False):
+        """Get amplitudes records as structured array or dict of columns.
+
+        Records are sorted by time, frequency and number.
+
+        Keyword arguments are the same as for iterResults;
+        asDict -- return dictionary of columns.
+        """
+        chunks = list(self.iterResults(
+            columns, time_from, time_to, frqs, numbers))
+        if chunks:
+            result = np.concatenate(chunks)
+            result = result[np.lexsort(
+                (result['number'], result['frequency'], result['time']))]
+        else:
+            result = np.empty(
+                0, dtype=self.getResultsDtype(self.checkColumns(columns)))
+
+        if asDict:
+            return dict((name, result[name]) for name in result.dtype.names)
+
+        return result
 
     def close(self):
         "Close DB connection."
 
         self._cur.close()
         self._con.close()
+
+
+class parusWriter(object):
+    """Class for bulk writing of files results in sqlite3 database.
+
+    Ids of files and frequencies and already saved (file, frequency)
+    pairs are loaded once, rows of a file are inserted by executemany
+    and transactions are committed for batches of files.
+    """
+
+    def __init__(self, con, batchSize=50, wal=False, synchronous=None):
+        """Init writer for the database connection.
+
+        Keyword arguments:
+        con -- sqlite3 connection;
+        batchSize -- number of files in one transaction;
+        wal -- switch the database to write-ahead log journal
+        (not for databases on network drives), synchronous mode is
+        NORMAL by default for it (safe with WAL);
+        synchronous -- sqlite3 synchronous mode for this session
+        (None - NORMAL for WAL journal and the default mode otherwise).
+        """
+        super().__init__()
+        self._con = con
+        self._cur = con.cursor()
+        self._batchSize = batchSize
+        self._pending = 0
+
+        # In sqlite3 foreign key constraints are disabled by default
+        # for performance reasons. PRAGMA statement enables them.
+        self._cur.execute("PRAGMA foreign_keys = ON")
+        if wal:
+            self._cur.execute("PRAGMA journal_mode = WAL")
+            if synchronous is None:
+                synchronous = 'NORMAL'
+        if synchronous:
+            self._cur.execute(
+                "PRAGMA synchronous = {}".format(synchronous))
+
+        self._cur.execute('SELECT frequency, id_frq FROM frequencies')
+        self._frq_ids = dict(self._cur.fetchall())
+        self._cur.execute('SELECT filename, id_file FROM files')
+        self._file_ids = dict(self._cur.fetchall())
+        self._cur.execute(
+            'SELECT DISTINCT ampl_file, ampl_frq FROM amplitudes')
+        self._pairs = set(self._cur.fetchall())
+
+    def isIngested(self, name):
+        """Check existence of the file in the database.
+
+        Keyword arguments:
+        name -- file name without directory.
+        """
+        return name in self._file_ids
+
+    def fileId(self, name, time, dt, dh):
+        """Get id of the file, create record if not exist."""
+        file_id = self._file_ids.get(name)
+        if file_id is None:  # create record
+            self._cur.execute(
+                'insert into files '
+                '(filename, time, dt, dh) values (?,?,?,?)',
+                (name, time, dt, dh))
+            file_id = self._file_ids[name] = self._cur.lastrowid
+
+        return file_id
+
+    def frequencyIds(self, frqs):
+        """Get ids of frequencies, create records if not exist."""
+        frq_ids = []
+        for frq in frqs:
+            frq = int(frq)
+            frq_id = self._frq_ids.get(frq)
+            if frq_id is None:  # create record
+                self._cur.execute(
+                    'INSERT INTO frequencies '
+                    '(frequency) values (?)', (frq,))
+                frq_id = self._frq_ids[frq] = self._cur.lastrowid
+            frq_ids.append(frq_id)
+
+        return frq_ids
+
+    def addHardResults(self, info, results):
+        """Save results of parusFile.HardCalculation for the file.
+
+        Keyword arguments:
+        info -- dictionary with name, time, dt, dh and frqs of the file;
+        results -- results of parusFile.HardCalculation.
+        """
+        file_id = self.fileId(
+            info['name'], info['time'], info['dt'], info['dh'])
+        frq_ids = self.frequencyIds(info['frqs'])
+        # sqlite3 adapts np.float64 only (single precision results)
+        results = dict(
+            (key, np.asarray(value, dtype=float))
+            for key, value in results.items())
+
+        rows = []
+        updates = []
+        n_refs = results['A_eff'].shape[1]
+        for i_frq, frq_id in enumerate(frq_ids):
+            n_rows = len(rows)
+            counts = results['counts'][i_frq]
+            L_mean = results['L_mean'][i_frq]
+            if (file_id, frq_id) in self._pairs:  # exist
+                if counts:
+                    updates.append((L_mean, counts, file_id, frq_id))
+                continue
+
+            for i_ref in range(n_refs):  # by reflection
+                if np.isnan(results['A_eff'][i_frq, i_ref]):
+                    break
+                if results['A_std'][i_frq, i_ref] == 0:
+                    break
+                is_L = counts and i_ref == 1
+                rows.append((
+                    file_id, frq_id, i_ref,
+                    results['A_eff'][i_frq, i_ref],
+                    results['A_std'][i_frq, i_ref],
+                    results['n_std'][i_frq, i_ref],
+                    results['h_eff'][i_frq, i_ref],
+                    results['h_std'][i_frq, i_ref],
+                    L_mean if is_L else None,
+                    counts if is_L else None))
+            if len(rows) > n_rows:
+                self._pairs.add((file_id, frq_id))
+
+        with pm.metrics.timer('db write'):
+            self._cur.executemany(
+                'INSERT INTO amplitudes '
+                '(ampl_file, ampl_frq, number, '
+                'a_eff, a_std, n_std, h_eff, h_std, L_mean, counts) '
+                'VALUES(?,?,?,?,?,?,?,?,?,?)', rows)
+            self._cur.executemany(
+                'UPDATE amplitudes SET L_mean = ?, counts = ? '
+                'WHERE ampl_file = ? AND ampl_frq = ? AND number = 1',
+                updates)
+        pm.metrics.count('rows inserted', len(rows))
+        pm.metrics.count('rows updated', len(updates))
+        self.fileDone()
+
+    def addSpectralResults(self, info, results, power0, power1, Pnoise,
+                           ref_count):
+        """Save results of parusFile.SpectralCalculation for the file.
+
+        Keyword arguments:
+        info -- dictionary with name, time, dt, dh and frqs of the file;
+        results -- results of parusFile.SpectralCalculation;
+        power0, power1, Pnoise -- powers of reflections and noise;
+        ref_count -- reflections count.
+        """
+        file_id = self.fileId(
+            info['name'], info['time'], info['dt'], info['dh'])
+        frq_ids = self.frequencyIds(info['frqs'])
+
+        rows = []
+        for i_frq, frq_id in enumerate(frq_ids):
+            if (file_id, frq_id) in self._pairs:  # exist
+                continue
+            self._pairs.add((file_id, frq_id))
+            rows.append((
+                file_id, frq_id,
+                power0[i_frq], power1[i_frq], Pnoise[i_frq],
+                results['h_eff'][i_frq, 0],
+                results['h_std'][i_frq, 0],
+                results['h_eff'][i_frq, 1],
+                results['h_std'][i_frq, 1],
+                ref_count))
+
+        with pm.metrics.timer('db write'):
+            self._cur.executemany(
+                'INSERT INTO amplitudes '
+                '(ampl_file, ampl_frq, '
+                'power0, power1, Pnoise, '
+                'h0_eff, h0_std, h1_eff, h1_std, count) '
+                'VALUES(?,?,?,?,?,?,?,?,?,?)', rows)
+        pm.metrics.count('rows inserted', len(rows))
+        self.fileDone()
+
+    def fileDone(self):
+        "Commit transaction for the full batch of files."
+        self._pending += 1
+        if self._pending >= self._batchSize:
+            self.commit()
+
+    @pm.metrics.timed('db commit')
+    def commit(self):
+        "Commit pending files."
+        self._con.commit()
+        self._pending = 0
+
+    def close(self):
+        "Commit pending files and close cursor (not connection)."
+        self.commit()
+        self._cur.close()
@@ -3,9 +3,87 @@
 Classes for work with a Parus ionosound data files.
 """
 import numpy as np
+import collections
+import concurrent.futures
 import time
 import os
 
+import parusStats as ps
+import parusMetrics as pm
+from parusCache import cachedResult
+
+
+# Data structure of a file header.
+headerDtype = np.dtype(
+    [('ver', 'I'),          # version number
+     ('time',               # GMT of sounding beginning.
+        [('sec', 'i'),      # seconds after the minute (0-60*)
+         ('min', 'i'),      # minutes after the hour (0-59)
+         ('hour', 'i'),     # hours since midnight (0-23)
+         ('mday', 'i'),     # day of the month (1-31)
+         ('mon', 'i'),      # months since January (0-11)
+         ('year', 'i'),     # years since 1900
+         ('wday', 'i'),     # days since Sunday (0-6)
+         ('yday', 'i'),     # days since January 1 (0-365)
+         ('isdst', 'i')]),  # Daylight Saving Time flag
+     ('height_min', 'I'),   # beginning height, km
+     ('height_max', 'I'),   # ending height, km
+     ('height_step', 'I'),  # heights step, m (real ADC step)
+     ('count_height', 'I'),  # number of heights (max 512)
+     ('count_modules', 'I'),  # number of modules/frequencies
+     ('pulse_frq', 'I')])   # switching frequency, Hz
+
+
+def headerTime(hdr):
+    """Get GMT of sounding beginning from unpacked header.
+
+    Keyword arguments:
+    hdr -- array of headerDtype with one element.
+    """
+    t = hdr['time']
+    tt = (
+        t['year'][0]+1900, t['mon'][0]+1, t['mday'][0],
+        t['hour'][0], t['min'][0], t['sec'][0],
+        t['wday'][0], t['yday'][0], t['isdst'][0])
+
+    return time.struct_time(tt)
+
+
+def headerHeights(hdr, name=''):
+    """Forming the array of heights for real amplitudes.
+
+    Keyword arguments:
+    hdr -- array of headerDtype with one element;
+    name -- name of the data file for error messages.
+    """
+    version, = hdr['ver']
+    h_step = hdr['height_step'][0] / 1000  # in km
+    if version == 0 or version == 2:  # stripped sounding heights
+        # first reflection heights
+        h_min, = hdr['height_min']
+        h_max, = hdr['height_max']
+        DH = h_max - h_min
+        num = int(1 + DH // h_step)
+        h1 = np.linspace(h_min, h_max, num)
+
+        # second reflection heights
+        h_min_2 = h_min * 2
+        h_max_2 = h_min_2 + DH
+        h2 = np.linspace(h_min_2, h_max_2, num)
+        heights = np.concatenate((h1, h2), axis=0)
+
+    elif version == 1:  # full list of sounding heights
+        n_heights, = hdr['count_height']
+        h_max = n_heights * h_step
+        heights = np.arange(0, h_max, h_step)
+
+    else:  # unsupported version
+        raise ValueError(
+            'Unsupported version {} of the data file {}!'.format(
+                version, name))
+
+    return heights
+
 
 class header(object):
     "Class for work with a header of a data file."
@@ -21,34 +99,11 @@ class header(object):
 
         self._file.seek(0, 0)
         # Unpack data structure from a file header.
-        _dtype = np.dtype(
-            [('ver', 'I'),          # version number
-             ('time',               # GMT of sounding beginning.
-                [('sec', 'i'),      # seconds after the minute (0-60*)
-                 ('min', 'i'),      # minutes after the hour (0-59)
-                 ('hour', 'i'),     # hours since midnight (0-23)
-                 ('mday', 'i'),     # day of the month (1-31)
-                 ('mon', 'i'),      # months since January (0-11)
-                 ('year', 'i'),     # years since 1900
-                 ('wday', 'i'),     # days since Sunday (0-6)
-                 ('yday', 'i'),     # days since January 1 (0-365)
-                 ('isdst', 'i')]),  # Daylight Saving Time flag
-             ('height_min', 'I'),   # beginning height, km
-             ('height_max', 'I'),   # ending height, km
-             ('height_step', 'I'),  # heights step, m (real ADC step)
-             ('count_height', 'I'),  # number of heights (max 512)
-             ('count_modules', 'I'),  # number of modules/frequencies
-             ('pulse_frq', 'I')])   # switching frequency, Hz
-        self._header = np.fromfile(self._file, _dtype, count=1)
+        self._header = np.fromfile(self._file, headerDtype, count=1)
 
         count_modules, = self._header['count_modules']
         self._dt, = count_modules / self._header['pulse_frq']
-        t = self._header['time']
-        tt = (
-            t['year'][0]+1900, t['mon'][0]+1, t['mday'][0],
-            t['hour'][0], t['min'][0], t['sec'][0],
-            t['wday'][0], t['yday'][0], t['isdst'][0])
-        self._time = time.struct_time(tt)
+        self._time = headerTime(self._header)
         # Reading of sounding frequencies, Hz
         self._frqs = np.fromfile(
             self._file,
@@ -83,34 +138,83 @@ class header(object):
     def getHeights(self):
         """Forming the array of heights for real amplitudes.
         """
+        return headerHeights(self._header, self._file.name)
+
 
-        version = self._header['ver']
-        h_step = self._header['height_step'] / 1000  # in km
-        if version == 0 or version == 2:  # stripped sounding heights
-            # first reflection heights
-            h_min = self._header['height_min']
-            h_max = self._header['height_max']
-            DH = h_max - h_min
-            num = 1 + DH // h_step
-            h1 = np.linspace(h_min, h_max, num)
-
-            # second reflection heights
-            h_min_2 = h_min * 2
-            h_max_2 = h_min_2 + DH
-            h2 = np.linspace(h_min_2, h_max_2, num)
-            heights = np.concatenate((h1, h2), axis=0)
-
-        elif version == 1:  # full list of sounding heights
-            n_heights, = self._header['count_height']
-            h_max = n_heights * h_step
-            heights = np.arange(0, h_max, h_step)
-
-        else:  # unsupported version
+# Compact description of a data file (see scanHeader).
+headerRecord = collections.namedtuple(
+    'headerRecord',
+    ['name', 'path', 'size', 'mtime', 'version', 'time', 'dt', 'frqs',
+     'height_min', 'height_max', 'height_step', 'count_height',
+     'count_heights', 'units'])
+
+
+def scanHeader(filename):
+    """Get description of a data file from its header only.
+
+    The file is not mapped and heights are not formed, so it is
+    cheap for big lists of files. Return headerRecord.
+
+    Keyword arguments:
+    filename -- name of the data file.
+    """
+    # header and usual frequencies table are read by one call
+    with open(filename, 'rb', buffering=0) as f:
+        st = os.fstat(f.fileno())
+        buf = f.read(headerDtype.itemsize + 64 * 4)
+        if len(buf) < headerDtype.itemsize:
             raise ValueError(
-                'Unsupported version {} of the data file {}!'.format(
-                    version, self._file))
+                'The data file {} is too short!'.format(filename))
+        hdr = np.frombuffer(buf, headerDtype, count=1)
+
+        count_modules, = hdr['count_modules']
+        datapos = headerDtype.itemsize + 4 * count_modules
+        if len(buf) < datapos:
+            buf += f.read(datapos - len(buf))
+    frqs = np.frombuffer(
+        buf, np.uint32, count_modules, headerDtype.itemsize).copy()
+
+    count_heights = headerHeights(hdr, filename).size
+    unitSize = np.dtype(np.int16).itemsize * 2 * count_heights * count_modules
+    units = int(max(st.st_size - datapos, 0) // unitSize) if unitSize else 0
+
+    return headerRecord(
+        name=os.path.basename(filename),
+        path=filename,
+        size=st.st_size,
+        mtime=st.st_mtime,
+        version=int(hdr['ver'][0]),
+        time=headerTime(hdr),
+        dt=float(count_modules / hdr['pulse_frq'][0]),
+        frqs=frqs,
+        height_min=int(hdr['height_min'][0]),
+        height_max=int(hdr['height_max'][0]),
+        height_step=int(hdr['height_step'][0]),
+        count_height=int(hdr['count_height'][0]),
+        count_heights=count_heights,
+        units=units)
+
+
+def scanHeaders(filenames, workers=8, skipErrors=False):
+    """Get descriptions of data files by the pool of threads.
+
+    Return list of headerRecord in the order of filenames.
+
+    Keyword arguments:
+    filenames -- names of data files;
+    workers -- number of threads (reading is bounded by I/O latency);
+    skipErrors -- None instead of headerRecord for unreadable files.
+    """
+    scan = scanHeader
+    if skipErrors:
+        def scan(filename):
+            try:
+                return scanHeader(filename)
+            except (OSError, ValueError):
+                return None
 
-        return heights
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(scan, filenames))
 
 
 class parusIntervals(object):
@@ -191,7 +295,36 @@ class parusFile(header):
     """Class for reading multifrequencies data from the big file.
     """
 
-    def __init__(self, filename):
+    # types of magnitudes and complex amplitudes of decoded units
+    precisions = {
+        'double': (np.float64, np.complex128),
+        'single': (np.float32, np.complex64)}
+
+    # accumulators of FullCalculation analyses, methods and their
+    # arguments which give the same results
+    analyses = {
+        'statistics': (ps.profileAccumulator, 'getStatistics', {}),
+        'hard': (ps.hardAccumulator, 'HardCalculation', {'streaming': True}),
+        'spectral': (ps.spectralAccumulator, 'SpectralCalculation', {})}
+
+    def __init__(self, filename, blockSize=256, cache=None,
+                 frqs=None, windows=None, localTheresholds=False,
+                 precision='double', theresholdMethod='std',
+                 theresholdFactor=None):
+        """Open data file.
+
+        Keyword arguments:
+        filename -- name of the data file;
+        blockSize -- number of units decoded at once by block readers;
+        cache -- parusCache object for results of analyses (or None);
+        frqs, windows, localTheresholds -- selected frequencies and
+        heights windows (see select);
+        precision -- 'double' or 'single' precision of decoded units
+        (quadratures have about 14 significant bits, so 'single' is
+        enough for analyses and takes half of memory);
+        theresholdMethod, theresholdFactor -- method of theresholds of
+        reflections (see getTheresholds).
+        """
 
         # Raise os.error if the file does not exist or is inaccessible.
         _filesize = os.path.getsize(filename)
@@ -199,90 +332,473 @@ class parusFile(header):
 
         super().__init__(self._file)
 
-        # Since offset is measured in bytes, it should normally be a
-        # multiple of the byte-size of dtype.
-        _dtype = np.int16
-        _offset = self._datapos
+        # All frequencies and heights of the file (self._frqs and
+        # self._heights are selected from them)
+        self._fileFrqs = self._frqs
+        self._fileHeights = self._heights
+
         self._rows = 2 * self._heights.size  # two quadrature np.int16
         self._cols = self._frqs.size
-
-        unitSize = np.dtype(_dtype).itemsize * self._rows * self._cols
-        dataSize = _filesize - _offset
-        self._units = dataSize // unitSize
-
-        self._mmap = np.memmap(
-            self._file,
-            dtype=_dtype,
-            mode='r',
-            offset=_offset,
-            shape=(self._units, self._cols, self._rows),
-            order='C')
+        self._units = self.countUnits(_filesize)
+        self._mmap = self.mapUnits(self._units)
 
         # Simple intervals define, km
-        self._intervals = parusIntervals()
+        self._intervals = parusIntervals().intervals
+        self.select(frqs, windows, localTheresholds)
+        self.blockSize = blockSize
+        self.precision = precision
+        self.theresholdMethod = theresholdMethod
+        self.theresholdFactor = theresholdFactor
+        self.cache = cache
 
     # property BEGIN
     @property
     def intervals(self):
-        return self._intervals.intervals
+        return self._intervals
+
+    @intervals.setter
+    def intervals(self, value):
+        if isinstance(value, parusIntervals):
+            value = value.intervals
+        value = np.array(value, dtype=float)
+        if value.ndim != 3 or value.shape[-1] != 2:
+            raise ValueError(
+                'Unsupported shape {} of heights intervals!'.format(
+                    value.shape))
+        self._intervals = value
+        self.updateRanges()
 
     @property
     def heights(self):
         return self._heights
 
+    @property
+    def units(self):
+        return self._units
+
+    @property
+    def blockSize(self):
+        return self._blockSize
+
+    @blockSize.setter
+    def blockSize(self, value):
+        if not isinstance(value, int) or value < 1:
+            raise ValueError(
+                'Unsupported block size <{}>!'.format(value))
+        self._blockSize = value
+
+    @property
+    def precision(self):
+        return self._precision
+
+    @precision.setter
+    def precision(self, value):
+        if value not in self.precisions:
+            raise ValueError(
+                'Unsupported precision <{}>!'.format(value))
+        self._precision = value
+        self._realType, self._complexType = self.precisions[value]
+
+    @property
+    def theresholdMethod(self):
+        return self._theresholdMethod
+
+    @theresholdMethod.setter
+    def theresholdMethod(self, value):
+        if value not in ps.theresholdMethods:
+            raise ValueError(
+                'Unsupported thereshold method <{}>!'.format(value))
+        self._theresholdMethod = value
+
+    @property
+    def theresholdFactor(self):
+        return self._theresholdFactor
+
+    @theresholdFactor.setter
+    def theresholdFactor(self, value):
+        self._theresholdFactor = None if value is None else float(value)
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @cache.setter
+    def cache(self, value):
+        self._cache = value
+
     # property END
 
-    def getUnit(self, idTime):
-        """Get multifrequence data unit with complex amplitudes.
+    def getConfiguration(self):
+        """Get parameters which change results of analyses.
+
+        Used as a part of keys of cached results.
+        """
+        return (
+            self.intervals.tolist(),
+            self._frqIndexes.tolist(),
+            self._runs,
+            self._precision,
+            self._theresholdMethod,
+            self._theresholdFactor)
+
+    def select(self, frqs=None, windows=None, localTheresholds=False):
+        """Select frequencies and heights windows of decoded units.
+
+        Only selected columns and heights of the file are read and
+        decoded, frqs and heights properties and all analyses use
+        selected values. The last height of the file (noise) is always
+        selected. Call without arguments to select all the file.
+
+        Selection of frequencies does not change results for them.
+        Heights windows do: theresholds of reflections are calculated
+        over selected heights only (the full profile is not decoded),
+        so reflections and their counts differ from results for all
+        heights. Windows are used only with localTheresholds.
 
         Keyword arguments:
-        idTime -- time number (Unit number) from begin of sounding.
+        frqs -- sounding frequencies of the file (all if None);
+        windows -- list of (h_min, h_max) heights windows, km
+        (all heights if None);
+        localTheresholds -- confirm theresholds over heights windows.
+        """
+        if windows is not None and not localTheresholds:
+            raise ValueError(
+                'Heights windows change theresholds of reflections, '
+                'select them with localTheresholds!')
+
+        if frqs is None:
+            i_frqs = np.arange(self._fileFrqs.size)
+        else:
+            frqs = np.atleast_1d(frqs)
+            absent = np.setdiff1d(frqs, self._fileFrqs)
+            if absent.size:
+                raise ValueError(
+                    'Frequencies {} are absent in the file {}!'.format(
+                        absent.tolist(), self.name))
+            i_frqs, = np.nonzero(np.isin(self._fileFrqs, frqs))
+
+        heights = self._fileHeights
+        if windows is None:
+            is_selected = np.ones(heights.size, dtype=bool)
+        else:
+            is_selected = np.zeros(heights.size, dtype=bool)
+            for h_min, h_max in windows:
+                is_selected |= (heights >= h_min) & (heights <= h_max)
+        is_selected[-1] = True  # noise reference
+        i_heights, = np.nonzero(is_selected)
+
+        # Contiguous runs of selected heights are slices of the map
+        breaks, = np.nonzero(np.diff(i_heights) > 1)
+        starts = i_heights[np.concatenate(([0], breaks + 1))]
+        stops = i_heights[np.concatenate((breaks, [-1]))] + 1
+        self._runs = list(zip(starts.tolist(), stops.tolist()))
+        self._whole = (
+            i_frqs.size == self._fileFrqs.size and len(self._runs) == 1 and
+            self._runs[0] == (0, heights.size))
+
+        self._frqIndexes = i_frqs
+        self._frqs = self._fileFrqs[i_frqs]
+        self._heights = heights[i_heights]
+        self._cols = self._frqs.size
+
+        # Monotonic parts of heights (two parts for versions 0 and 2)
+        breaks, = np.nonzero(np.diff(self._heights) <= 0)
+        bounds = np.concatenate(([0], breaks + 1, [self._heights.size]))
+        self._segments = list(zip(bounds[:-1], bounds[1:]))
+
+        self.updateRanges()
+
+    def updateRanges(self):
+        """Compute ranges of heights indexes for intervals.
+
+        Ranges are used for all units, they are updated when
+        the intervals or the selection are changed.
+        """
+        # intervals can be given for more frequencies than the file has
+        i_frqs = self._frqIndexes[
+            self._frqIndexes < self._intervals.shape[0]]
+        self._ranges = self.getIntervalRanges(self._intervals[i_frqs])
+
+    def countUnits(self, filesize):
+        """Get number of complete units in the file of given size.
+
+        Keyword arguments:
+        filesize -- size of the data file, bytes.
+        """
+        unitSize = (
+            np.dtype(np.int16).itemsize * self._rows * self._fileFrqs.size)
+        dataSize = filesize - self._datapos
+
+        return max(dataSize // unitSize, 0)
+
+    def mapUnits(self, units):
+        """Map given number of units of the file to array.
+
+        Keyword arguments:
+        units -- number of complete units.
+        """
+        shape = (units, self._fileFrqs.size, self._rows)
+        if not units:  # empty file can not be mapped
+            return np.empty(shape, dtype=np.int16)
+
+        # Since offset is measured in bytes, it should normally be a
+        # multiple of the byte-size of dtype.
+        return np.memmap(
+            self._file,
+            dtype=np.int16,
+            mode='r',
+            offset=self._datapos,
+            shape=shape,
+            order='C')
+
+    def refresh(self):
+        """Map new complete units of the file which is still written.
+
+        Return number of new units. The map is not copied, only
+        the view of the file is extended.
+        """
+        units = self.countUnits(os.fstat(self._file.fileno()).st_size)
+        if units <= self._units:
+            return 0
+
+        new = units - self._units
+        self._mmap = self.mapUnits(units)
+        self._units = units
+
+        return new
+
+    def followUnits(self, start=0, interval=1., timeout=None,
+                    blockSize=None):
+        """Iterate over blocks of units of the file which is still written.
+
+        Yield the same as iterUnits: number of the first unit of the block,
+        magnitudes and complex amplitudes. Blocks contain units available
+        at the moment (no more than blockSize). Iteration stops if the file
+        does not grow during timeout seconds.
+
+        Keyword arguments:
+        start -- number of the first unit;
+        interval -- seconds between checks of the file size;
+        timeout -- seconds without new units before stop (None - never);
+        blockSize -- maximal number of units in the block
+        (self.blockSize if None).
+        """
+        if blockSize is None:
+            blockSize = self._blockSize
+        i = start
+        waited = 0.
+        while True:
+            self.refresh()
+            if i < self._units:
+                waited = 0.
+                stop = min(i + blockSize, self._units)
+                arr_abs, arr_c = self.getUnits(i, stop)
+                yield i, arr_abs, arr_c
+                i = stop
+                continue
+            if timeout is not None and waited >= timeout:
+                break
+            time.sleep(interval)
+            waited += interval
+
+    def readUnits(self, key):
+        """Get raw units of the file map.
+
+        Only selected frequencies and heights are copied from the map
+        (see select). With enabled metrics units are always copied,
+        so time of reading of the file is separated from decoding.
+
+        Keyword arguments:
+        key -- index or slice of units.
+        """
+        raw = self._mmap[key]
+        if not self._whole:
+            with pm.metrics.timer('read'):
+                raw = np.concatenate([
+                    raw[..., self._frqIndexes, 2 * start:2 * stop]
+                    for start, stop in self._runs], axis=-1)
+        elif pm.metrics.enabled:
+            with pm.metrics.timer('read'):
+                raw = np.array(raw)
+        if pm.metrics.enabled:
+            pm.metrics.count(
+                'units', raw.size // (raw.shape[-2] * raw.shape[-1]))
+            pm.metrics.count('bytes', raw.nbytes)
+
+        return raw
+
+    @pm.metrics.timed('decode')
+    def decodeUnits(self, raw):
+        """Decode raw quadratures to magnitudes and complex amplitudes.
+
+        Keyword arguments:
+        raw -- array of np.int16 with quadratures interleaved
+        along the last axis.
         """
-        raw = self._mmap[idTime, :, :]
         # two last bytes save channel information
         raw_shifted = np.right_shift(raw, 2)
         # get complex amplitude
-        result = np.array(raw_shifted[:, ::2], dtype=complex)
-        result.imag = raw_shifted[:, 1::2]
+        result = np.empty(
+            raw_shifted.shape[:-1] + (raw_shifted.shape[-1] // 2,),
+            dtype=self._complexType)
+        result.real = raw_shifted[..., ::2]
+        result.imag = raw_shifted[..., 1::2]
 
         return np.abs(result), result
 
-    def getAveragedMeans(self):
-        """Calculate averaged means for all frequencies.
+    @pm.metrics.timed('decode')
+    def decodeQuadratures(self, raw):
+        """Decode raw quadratures without conversion to float numbers.
+
+        Return np.int16 array with (..., heights, 2) shape, the last
+        axis is (I, Q) pair.
+
+        Keyword arguments:
+        raw -- array of np.int16 with quadratures interleaved
+        along the last axis.
         """
-        n_times = self._mmap.shape[0]
-        cur = self.getUnit(0)[0]  # initialize
-        ave = cur
-        ave2 = cur ** 2
-        for i in range(1, n_times):  # by times number
-            cur = self.getUnit(i)[0]
-            ave = (ave + cur)/2
-            ave2 = (ave2 + cur**2)/2
-        _ave2 = np.sqrt(ave2)
+        # two last bytes save channel information
+        raw_shifted = np.right_shift(raw, 2)
+
+        return raw_shifted.reshape(raw_shifted.shape[:-1] + (-1, 2))
+
+    @pm.metrics.timed('decode')
+    def decodePowers(self, raw):
+        """Decode raw quadratures to squared magnitudes.
+
+        Return np.int32 array, squares are summed in integers
+        (quadratures have 14 bits, so the sum can not overflow).
+
+        Keyword arguments:
+        raw -- array of np.int16 with quadratures interleaved
+        along the last axis.
+        """
+        raw_shifted = np.right_shift(raw, 2, dtype=np.int32)
+        powers = np.square(raw_shifted[..., ::2])
+        powers += np.square(raw_shifted[..., 1::2])
 
+        return powers
+
+    def getUnit(self, idTime):
+        """Get multifrequence data unit with complex amplitudes.
+
+        Keyword arguments:
+        idTime -- time number (Unit number) from begin of sounding.
+        """
+        return self.decodeUnits(self.readUnits(idTime))
+
+    def getUnits(self, start, stop):
+        """Get block of multifrequence data units with complex amplitudes.
+
+        Return arrays with (units, frequencies, heights) shape.
+
+        Keyword arguments:
+        start -- number of the first unit of the block;
+        stop -- number of the unit after the last unit of the block.
+        """
+        return self.decodeUnits(self.readUnits(slice(start, stop)))
+
+    def getQuadratures(self, start, stop):
+        """Get block of units as np.int16 (I, Q) pairs.
+
+        Return array with (units, frequencies, heights, 2) shape.
+
+        Keyword arguments:
+        start -- number of the first unit of the block;
+        stop -- number of the unit after the last unit of the block.
+        """
+        return self.decodeQuadratures(self.readUnits(slice(start, stop)))
+
+    def getPowers(self, start, stop):
+        """Get block of units as squared magnitudes (np.int32).
+
+        Return array with (units, frequencies, heights) shape.
+
+        Keyword arguments:
+        start -- number of the first unit of the block;
+        stop -- number of the unit after the last unit of the block.
+        """
+        return self.decodePowers(self.readUnits(slice(start, stop)))
+
+    def iterUnits(self, start=0, stop=None, blockSize=None):
+        """Iterate over blocks of multifrequence data units.
+
+        Yield number of the first unit of the block, magnitudes and
+        complex amplitudes with (units, frequencies, heights) shape.
+
+        Keyword arguments:
+        start -- number of the first unit;
+        stop -- number of the unit after the last unit (all units if None);
+        blockSize -- number of units in the block (self.blockSize if None).
+        """
+        if stop is None:
+            stop = self._mmap.shape[0]
+        if blockSize is None:
+            blockSize = self._blockSize
+        for i in range(start, stop, blockSize):
+            arr_abs, arr_c = self.getUnits(i, min(i + blockSize, stop))
+            yield i, arr_abs, arr_c
+
+    @cachedResult(2)
+    def getStatistics(self):
+        """Calculate statistics of magnitudes by single pass of the file.
+
+        Return dictionary with keys (arrays for all frequencies and heights):
+        mean -- mean magnitudes;
+        rms -- root mean square of magnitudes;
+        sigma -- standard deviation of magnitudes;
+        heights, amplitudes -- heights and rms amplitudes of maximums
+        in heights intervals for all frequencies and reflections.
+        """
+        acc = ps.profileAccumulator(self)
+        for i, arr_abs, arr_c in self.iterUnits():  # by blocks of times
+            acc.update(arr_abs, arr_c)
+
+        return acc.result()
+
+    def getIntervalPeaks(self, arr):
+        """Get heights and values of maximums in heights intervals.
+
+        Keyword arguments:
+        arr -- array of values for all frequencies and heights.
+        """
         n_refs = self.intervals.shape[1]
         heights = np.zeros([self._cols, n_refs])
         amplitudes = np.zeros([self._cols, n_refs])
         for i in range(self._cols):
             for j in range(n_refs):
-                cur_interv = self.intervals[i, j]
-                hmin = cur_interv[0]
-                hmax = cur_interv[1]
-                ind_h, = np.nonzero((self._heights >= hmin) & (self._heights <= hmax))
-                i_max = np.argmax(_ave2[i, ind_h]) + ind_h[0]
-                heights[i,j] = self._heights[i_max]
-                amplitudes[i,j] = _ave2[i, i_max]
+                i_max = self.getRangesMaximum(arr[i], self._ranges[i, j])
+                if i_max < 0:  # no heights in interval
+                    heights[i,j] = np.NaN
+                    amplitudes[i,j] = np.NaN
+                else:
+                    heights[i,j] = self._heights[i_max]
+                    amplitudes[i,j] = arr[i, i_max]
 
-        return ave, _ave2, heights, amplitudes
+        return heights, amplitudes
+
+    def getAveragedMeans(self):
+        """Calculate averaged means for all frequencies.
+
+        Return mean and root mean square magnitudes, heights and
+        amplitudes of maximums in heights intervals (see getStatistics).
+        """
+        stats = self.getStatistics()
+
+        return (
+            stats['mean'], stats['rms'],
+            stats['heights'], stats['amplitudes'])
 
     def getSigma(self, ave_means):
         """Calculate sigma for all heights and frequencies.
+
+        Sigma around the mean magnitudes is given by getStatistics
+        without the second pass of the file.
         """
         n_times = self._mmap.shape[0]
         tmp = np.zeros(ave_means.shape)
-        for i in range(n_times):  # by times number
-            arr = self.getUnit(i)[0]
-            tmp += (arr - ave_means)**2
+        for i, arr, _ in self.iterUnits():  # by blocks of times
+            tmp += np.sum((arr - ave_means)**2, axis=0)
         sigma = np.sqrt(tmp/(n_times - 1))
 
         return sigma
@@ -290,54 +806,140 @@ class parusFile(header):
     def getThereshold(self, arr):
         """Get thereshold for array.
         """
-        # # 0. Sort given np.array.
-        # arrSorted = np.sort(arr, axis=0, kind='mergesort')
-        # # 1. Get quartiles.
-        # n = arrSorted.size
-        # Q1 = np.amin((arrSorted[n//4], arrSorted[n//4-1]))
-        # Q3 = np.amin((arrSorted[3*n//4], arrSorted[3*n//4-1]))
-        # # 2. Get interval.
-        # dQ = Q3 - Q1
-        # # 3. Get top border of outliers. Search minor outliers.
-        # thereshold = Q3 + 1.5 * dQ
-        thereshold = np.mean(arr) + np.std(arr)
-
-        return thereshold
+        return self.getTheresholds(np.ravel(arr))
 
+    @pm.metrics.timed('thresholds')
     def getTheresholds(self, full_arr):
         """Get theresholds for fullarray.
+
+        Theresholds of all lines are calculated at once by the method
+        of the file: 'std' (mean + factor * std, factor is 1 by default),
+        'iqr' (Q3 + factor * IQR, factor is 1.5) or 'mad' (median +
+        factor * 1.4826 * MAD, factor is 3). Lines are the selected
+        heights (see select).
+
+        Keyword arguments:
+        full_arr -- array of magnitudes, heights are along the last axis
+        (frequencies or units and frequencies are along other axes).
         """
-        theresholds = np.empty(self._cols)
-        for i in range(self._cols):
-            theresholds[i] = self.getThereshold(full_arr[i, :])
+        method = ps.theresholdMethods[self._theresholdMethod]
+        if self._theresholdFactor is None:
+            return method(full_arr)
+
+        return method(full_arr, self._theresholdFactor)
+
+    def getIntervalRanges(self, intervals=None):
+        """Get ranges of heights indexes for intervals.
+
+        Return integer array with intervals.shape[:-1] + (parts, 2)
+        shape: (start, stop) indexes of heights inside interval for
+        every monotonic part of heights (one part for version 1 and
+        two parts for versions 0 and 2), empty range has stop <= start.
+
+        Keyword arguments:
+        intervals -- array of heights intervals with (..., 2) shape
+        (precomputed ranges of the file intervals if None).
+        """
+        if intervals is None:
+            return self._ranges
+
+        intervals = np.asarray(intervals)
+        ranges = np.empty(
+            intervals.shape[:-1] + (len(self._segments), 2), dtype=int)
+        for k, (begin, end) in enumerate(self._segments):
+            part = self._heights[begin:end]
+            ranges[..., k, 0] = begin + np.searchsorted(
+                part, intervals[..., 0], side='left')
+            ranges[..., k, 1] = begin + np.searchsorted(
+                part, intervals[..., 1], side='right')
+
+        return ranges
+
+    def getIntervalMasks(self):
+        """Get masks of heights for intervals of all frequencies.
+
+        Return boolean array with (frequencies, reflections, heights) shape.
+        """
+        ranges = self._ranges[:self._cols]
+        i_h = np.arange(self._heights.size)
+        masks = np.any(
+            (i_h >= ranges[..., 0, np.newaxis]) &
+            (i_h < ranges[..., 1, np.newaxis]), axis=-2)
+
+        return masks
+
+    def getRangesMaximum(self, arr, ranges, thereshold=None):
+        """Get index of maximum of line in ranges of heights indexes.
+
+        Return -9999 if ranges are empty or maximum is below thereshold.
+
+        Keyword arguments:
+        arr -- line of values along heights;
+        ranges -- (start, stop) pairs of heights indexes;
+        thereshold -- minimal value of maximum (or None).
+        """
+        i_max = -9999  # special no-value key
+        for start, stop in ranges:
+            if start < stop:
+                i = start + np.argmax(arr[start:stop])
+                if i_max < 0 or arr[i] > arr[i_max]:
+                    i_max = i
+        if i_max >= 0 and thereshold is not None and arr[i_max] < thereshold:
+            i_max = -9999
+
+        return i_max
 
-        return theresholds
+    @pm.metrics.timed('reflections')
+    def getReflectionIndexes(self, arr, theresholds, ranges=None):
+        """Get reflections indexes for block of units.
+
+        Vectorized version of applyIntervalsAndTheresholds for all
+        units and frequencies. Return array with (units, frequencies,
+        reflections) shape, -9999 is the special no-value key.
+
+        Keyword arguments:
+        arr -- magnitudes with (units, frequencies, heights) shape;
+        theresholds -- theresholds with (units, frequencies) shape;
+        ranges -- ranges of heights intervals (see getIntervalRanges).
+        """
+        if ranges is None:
+            ranges = self._ranges
+        n_refs = ranges.shape[1]
+
+        indexes = np.empty(arr.shape[:-1] + (n_refs,), dtype=int)
+        for i_frq in range(arr.shape[-2]):
+            line = arr[..., i_frq, :]
+            found = np.ones(line.shape[:-1], dtype=bool)
+            for i in range(n_refs):
+                # slice argmax, stop for first missed reflection
+                ind = np.full(line.shape[:-1], -1)
+                peak = np.full(line.shape[:-1], -np.inf)
+                for start, stop in ranges[i_frq, i]:
+                    if start < stop:
+                        cur = start + np.argmax(line[..., start:stop], axis=-1)
+                        value = np.take_along_axis(
+                            line, cur[..., np.newaxis], axis=-1)[..., 0]
+                        better = value > peak
+                        ind = np.where(better, cur, ind)
+                        peak = np.where(better, value, peak)
+                found &= (ind >= 0) & (peak >= theresholds[..., i_frq])
+                indexes[..., i_frq, i] = np.where(found, ind, -9999)
+
+        return indexes
 
     def getReflectionIndex(self, i_frq, arr, thereshold):
         """Get reflection height for input line.
 
         Return indexes of reflections or NaN if no reflection.
         """
-        intervals = self.intervals[i_frq]
-        n_refs = intervals.shape[0]
-        indexes = np.empty(n_refs, dtype=np.int)
-        indexes[:] = -9999  # special no-value key
+        ranges = self._ranges[i_frq]
+        n_refs = ranges.shape[0]
+        indexes = np.full(n_refs, -9999)  # special no-value key
 
-        i_ampl = np.nonzero(arr >= thereshold)[0]
-        if i_ampl.size:
-            for i in range(n_refs):
-                i_min = i_ampl[np.nonzero(
-                    self._heights[i_ampl] >= intervals[i, 0])[0]]
-                if i_min.size:
-                    i_max = i_min[np.nonzero(
-                        self._heights[i_min] <= intervals[i, 1])[0]]
-                    if i_max.size:
-                        ind = np.argmax(arr[i_max])
-                        indexes[i] = i_max[ind]
-                    else:
-                        break
-                else:
-                    break
+        for i in range(n_refs):
+            indexes[i] = self.getRangesMaximum(arr, ranges[i], thereshold)
+            if indexes[i] < 0:  # stop for first missed reflection
+                break
 
         return indexes
 
@@ -366,9 +968,64 @@ class parusFile(header):
 
         return Am, As, height
 
-    def HardCalculation(self):
+    def getHardReflections(self, arr_abs, arr_c, ranges=None):
+        """Get reflections for block of units.
+
+        Return complex amplitudes and heights of reflections with
+        (units, frequencies, reflections) shape (NaN if no reflection)
+        and noise (last point of heights) with (units, frequencies) shape.
+
+        Keyword arguments:
+        arr_abs, arr_c -- magnitudes and complex amplitudes of block;
+        ranges -- ranges of heights intervals (see getIntervalRanges).
+        """
+        thr = self.getTheresholds(arr_abs)
+
+        # get indexes for reflections
+        idxs = self.getReflectionIndexes(arr_abs, thr, ranges)
+        is_ref = idxs > 0
+        i_in = np.where(is_ref, idxs, 0)
+
+        s_plus_n = np.where(
+            is_ref, np.take_along_axis(arr_c, i_in, axis=-1), np.NaN)
+        heights = np.where(is_ref, self._heights[i_in], np.NaN)
+        noise = arr_c[:, :, -1]  # last point of heights
+
+        return s_plus_n, heights, noise
+
+    def getAbsorption(self, s_plus_n, noise_std):
+        """Get instant absorbtion for block of units.
+
+        Return ratio of the second and the first reflections with
+        (units, frequencies) shape (NaN if no second reflection).
+
+        Keyword arguments:
+        s_plus_n -- complex amplitudes of reflections (signal + noise);
+        noise_std -- standard deviation of noise.
+        """
+        is_ref = ~np.isnan(np.real(s_plus_n[:, :, 1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            A1 = np.sqrt(np.abs(s_plus_n[:, :, 0])**2 - noise_std**2)
+            A2 = np.sqrt(np.abs(s_plus_n[:, :, 1])**2 - noise_std**2)
+            rho = np.where(is_ref, 2 * A2 / A1, np.NaN)
+
+        return rho
+
+    @cachedResult(1)
+    def HardCalculation(self, streaming=False):
         """True calculation file parameters.
+
+        Keyword arguments:
+        streaming -- keep only running sums for frequencies and
+        reflections, so memory does not depend on the file length.
         """
+        if streaming:
+            acc = ps.hardAccumulator(self)
+            for i, arr_abs, arr_c in self.iterUnits():  # by blocks of times
+                acc.update(arr_abs, arr_c)
+
+            return acc.result()
+
         # Output formatting
         keys = ['A_eff', 'A_std', 'n_std', 'h_eff', 'h_std', 'L_mean', 'counts']
         results = dict.fromkeys(keys)
@@ -378,58 +1035,37 @@ class parusFile(header):
 
         # Get real reflections indexes
         heights = np.empty([n_times, self._cols, n_refs])
-        heights[:] = np.NaN
         # signal + noise
-        s_plus_n = np.empty([n_times, self._cols, n_refs], np.complex)
-        s_plus_n[:] = np.NaN
+        s_plus_n = np.empty([n_times, self._cols, n_refs], self._complexType)
         # noise
-        noise = np.empty([n_times, self._cols, n_refs], np.complex)
-        noise[:] = np.NaN
+        noise = np.empty([n_times, self._cols, n_refs], self._complexType)
         # noise
         noise_std = np.zeros([n_times, self._cols])
-        for i in range(n_times):  # by times number
-            arr_abs, arr_c = self.getUnit(i)
-            thr = self.getTheresholds(arr_abs)
-
-            for j in range(self._cols):  # by frequencies
-                # get indexes for reflections
-                idxs = self.applyIntervalsAndTheresholds(
-                    self.intervals[j], thr[j], arr_abs[j, :])
-                i_in = np.extract(idxs > 0, idxs)
-                i_to = np.nonzero(idxs > 0)[0]
-
-                s_plus_n[i, j, i_to] = arr_c[j, i_in]
-                noise[i, j, :] = arr_c[j, -1]  # last point of heights
-
-                heights[i, j, i_to] = self._heights[i_in]
-
-                noise_std[i, j] = np.std(arr_c[j, -1])
-
-        s_n_2 = np.nanmean(np.abs(s_plus_n)**2, 0)
-        n_2 = np.mean(np.abs(noise)**2, 0)
-
-        results['A_eff'] = np.sqrt( s_n_2 - n_2 )
-        results['A_std'] = np.nanstd(np.abs(s_plus_n), 0)
-
-        results['n_std'] = np.nanstd(np.abs(noise), 0)
-        results['h_eff'] = np.nanmean(heights, 0)
-        results['h_std'] = np.nanstd(heights, 0)
-
-        # Calculate of instant absorbtion
-        rho = np.empty([n_times, self._cols])
-        rho[:] = np.NaN
-        counts = np.zeros(self._cols)
-        for i in range(self._cols):  # by frequencies
-            i_times = np.nonzero(~np.isnan(np.real(s_plus_n[:,i,1])))[0]
-            n_std = noise_std[i_times, i]
-            counts[i] = i_times.size  # number of points
-            A1 = np.sqrt(
-                np.abs(s_plus_n[i_times, i, 0])**2 - n_std**2)
-            A2 = np.sqrt(
-                np.abs(s_plus_n[i_times, i, 1])**2 - n_std**2)
-            rho[i_times, i] = 2 * A2 / A1
-        rho_mean = np.nanmean(rho, 0)
-        L = 20 * np.log10(rho_mean)
+        for i, arr_abs, arr_c in self.iterUnits():  # by blocks of times
+            i_block = slice(i, i + arr_abs.shape[0])
+            s_plus_n[i_block], heights[i_block], _noise = \
+                self.getHardReflections(arr_abs, arr_c)
+            noise[i_block] = _noise[:, :, np.newaxis]
+            # std of the single noise point
+            noise_std[i_block] = np.std(_noise[:, :, np.newaxis], axis=-1)
+
+        with pm.metrics.timer('reduce'):
+            s_n_2 = np.nanmean(np.abs(s_plus_n)**2, 0)
+            n_2 = np.mean(np.abs(noise)**2, 0)
+
+            results['A_eff'] = np.sqrt( s_n_2 - n_2 )
+            results['A_std'] = np.nanstd(np.abs(s_plus_n), 0)
+
+            results['n_std'] = np.nanstd(np.abs(noise), 0)
+            results['h_eff'] = np.nanmean(heights, 0)
+            results['h_std'] = np.nanstd(heights, 0)
+
+            # Calculate of instant absorbtion
+            is_ref = ~np.isnan(np.real(s_plus_n[:, :, 1]))
+            counts = np.count_nonzero(is_ref, 0).astype(float)  # number of points
+            rho = self.getAbsorption(s_plus_n, noise_std)
+            rho_mean = np.nanmean(rho, 0)
+            L = 20 * np.log10(rho_mean)
 
         results['L_mean'] = L
         results['counts'] = counts
@@ -441,106 +1077,125 @@ class parusFile(header):
 
         Return indexes of reflections or NaN if no reflection.
         """
-        n_refs = intervals.shape[0]
-        indexes = np.empty(n_refs, dtype=np.int)
-        indexes[:] = -9999  # special no-value key
+        ranges = self.getIntervalRanges(intervals)
+        n_refs = ranges.shape[0]
+        indexes = np.full(n_refs, -9999)  # special no-value key
 
-        i_ampl = np.nonzero(arr >= thereshold)[0]
-        if i_ampl.size:
-            for i in range(n_refs):
-                i_min = i_ampl[np.nonzero(
-                    self._heights[i_ampl] >= intervals[i, 0])[0]]
-                if i_min.size:
-                    i_max = i_min[np.nonzero(
-                        self._heights[i_min] <= intervals[i, 1])[0]]
-                    if i_max.size:
-                        ind = np.argmax(arr[i_max])
-                        indexes[i] = i_max[ind]
-                    else:
-                        break
-                else:
-                    break
+        for i in range(n_refs):
+            indexes[i] = self.getRangesMaximum(arr, ranges[i], thereshold)
+            if indexes[i] < 0:  # stop for first missed reflection
+                break
 
         return indexes
 
+    def fillIndexesGaps(self, indexes):
+        """Fill gaps of reflections indexes in time.
+
+        Leading gap gets the first found index, trailing gap gets
+        the last found index, interior gap gets the rounded mean of
+        indexes at its borders. Lines without reflections stay -9999.
+
+        Keyword arguments:
+        indexes -- array of indexes with times along the first axis
+        (-9999 for missed reflections).
+        """
+        n_times = indexes.shape[0]
+        missed = indexes < 0
+        times = np.arange(n_times).reshape(
+            (n_times,) + (1,) * (indexes.ndim - 1))
+
+        # times of the nearest found indexes before and after every time
+        t_prev = np.maximum.accumulate(
+            np.where(missed, -1, times), axis=0)
+        t_next = np.minimum.accumulate(
+            np.where(missed, n_times, times)[::-1], axis=0)[::-1]
+        is_prev = t_prev >= 0
+        is_next = t_next < n_times
+        i_prev = np.take_along_axis(
+            indexes, np.where(is_prev, t_prev, 0), axis=0)
+        i_next = np.take_along_axis(
+            indexes, np.where(is_next, t_next, 0), axis=0)
+
+        filled = np.where(
+            is_prev & is_next,
+            np.rint((i_prev + i_next) / 2).astype(int),
+            np.where(is_prev, i_prev, np.where(is_next, i_next, -9999)))
+
+        return np.where(missed, filled, indexes)
+
+    @cachedResult(1)
     def SpectralCalculation(self):
         """Spectral estimation.
+
+        Units are read and decoded once, gaps of reflections are filled
+        while the file is read (see parusStats.spectralAccumulator).
         """
-        # Output formatting
-        keys = ['signal', 'noise', 'h_eff', 'h_std']
-        results = dict.fromkeys(keys)
+        acc = ps.spectralAccumulator(self)
+        for i, arr_abs, arr_c in self.iterUnits():  # by blocks of times
+            acc.update(arr_abs, arr_c)
 
-        n_times = self._mmap.shape[0]
-        n_refs = self.intervals.shape[1]
+        return acc.result()
 
-        # Get real reflections indexes
-        heights = np.empty([n_times, self._cols, 2])
-        heights[:] = np.NaN
-        # signal + noise
-        s_plus_n = np.empty([n_times, self._cols, 2], np.complex)
-        s_plus_n[:] = np.NaN
-        # noise
-        noise = np.empty([n_times, self._cols], np.complex)
-        noise[:] = np.NaN
-        # noise
-        noise_std = np.zeros([n_times, self._cols])
-        # indexes
-        indexes = np.empty([n_times, self._cols, 2], dtype=np.int)
-        indexes[:] = -9999
-
-        # 1. get only signal, noise = NaN
-        for i in range(n_times):  # by times number
-            arr_abs, arr_c = self.getUnit(i)
-
-            noise[i, :] = arr_c[:, -1]  # last point of heights
-            thr = self.getTheresholds(arr_abs)
-
-            for j in range(self._cols):  # by frequencies
-                # get indexes for reflections
-                idxs = self.applyIntervalsAndTheresholds(
-                    self.intervals[j], thr[j], arr_abs[j, :])
-                indexes[i, j, :] = idxs[0:2]  # only two reflections
-
-        # 2. get indexes of NaN signal
-        for i in range(self._cols):  # by frequencies
-            for j in range(2):  # by reflections - only two reflections
-                indBeg = 0
-                indEnd = 0
-                key = 0
-                iarr = indexes[:, i, j]
-                for k in range(n_times):
-                    if iarr[k] < 0:
-                        if key == 0:
-                            indBeg = k
-                            key = 1
-                        indEnd = k
-                        if indEnd < n_times-1:
-                            continue
-
-                    if key == 1:
-                        if indBeg == 0:
-                            indMean = indexes[k, i, j]
-                        elif indEnd == n_times-1:
-                            indMean = indexes[indBeg-1, i, j]
-                        else:
-                            kBeg = indBeg - 1
-                            indMean = np.rint((indexes[kBeg, i, j] + indexes[k, i, j])/2)
-
-                        indexes[indBeg:indEnd+1, i, j] = indMean.astype(int)
-                        key = 0
-
-        # 3. set "bad signal" rather NaN
-        for i in range(n_times):  # by times number
-            arr_abs, arr_c = self.getUnit(i)
-
-            for j in range(self._cols):  # by frequencies
-                idxs = indexes[i, j, 0:2]  # only two reflections
-                s_plus_n[i, j, :] = arr_c[j, idxs]
-                heights[i, j, :] = self.heights[idxs]
-
-        results['signal'] = s_plus_n
-        results['noise'] = noise
-        results['h_eff'] = np.mean(heights, 0)
-        results['h_std'] = np.std(heights, 0)
+    def accumulate(self, accumulators, start=0, stop=None):
+        """Feed accumulators by single pass of units.
+
+        Every block of units is decoded once and given to all
+        accumulators. Return dictionary of their results by names.
+        Accumulators use only the given blocks (they do not read the
+        file), so results are the results of units from start to stop.
+
+        Keyword arguments:
+        accumulators -- dictionary of accumulators by names (objects
+        with update(arr_abs, arr_c) and result() methods, see
+        parusStats.hardAccumulator);
+        start -- number of the first unit;
+        stop -- number of the unit after the last unit (all units if None).
+        """
+        if accumulators:
+            for i, arr_abs, arr_c in self.iterUnits(start, stop):
+                for acc in accumulators.values():
+                    acc.update(arr_abs, arr_c)
+
+        return dict(
+            (name, acc.result()) for name, acc in accumulators.items())
+
+    def FullCalculation(self, names=('statistics', 'hard', 'spectral'),
+                        custom=None):
+        """Calculate several analyses by single pass of the file.
+
+        Results of standard analyses are the same as results of their
+        methods (see parusFile.analyses), they are taken from and saved
+        in the cache with keys of the methods.
+
+        Return dictionary of results by names of analyses.
+
+        Keyword arguments:
+        names -- names of standard analyses ('statistics', 'hard',
+        'spectral');
+        custom -- dictionary of other accumulators by names.
+        """
+        custom = custom or {}
+        for name in names:
+            if name not in self.analyses or name in custom:
+                raise ValueError(
+                    'Unsupported analysis <{}>!'.format(name))
+
+        results = {}
+        accumulators = {}
+        keys = {}
+        for name in names:
+            accumulator, method, kwargs = self.analyses[name]
+            if self._cache is not None:
+                keys[name] = getattr(self, method).getKey(self, **kwargs)
+                results[name] = self._cache.load(keys[name])
+                if results[name] is not None:
+                    continue
+            accumulators[name] = accumulator(self)
+
+        accumulators.update(custom)
+        results.update(self.accumulate(accumulators))
+        for name, key in keys.items():
+            if name in accumulators:
+                self._cache.save(key, results[name])
 
         return results
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Timers and counters of processing stages.
+
+Metrics are collected by the module object `metrics` only if it is
+enabled, otherwise timers and counters cost one attribute check.
+"""
+import contextlib
+import functools
+import json
+import time
+
+
+class parusMetrics(object):
+    """Class for accumulated timers and counters of named stages."""
+
+    def __init__(self):
+        super().__init__()
+        self._enabled = False
+        self._null = contextlib.nullcontext()
+        self.reset()
+
+    # property BEGIN
+    @property
+    def enabled(self):
+        return self._enabled
+    # property END
+
+    def enable(self, value=True):
+        """Switch on (or off) collection of metrics.
+
+        Keyword arguments:
+        value -- collect metrics.
+        """
+        self._enabled = value
+
+    def reset(self):
+        "Remove collected metrics."
+        self._timers = {}
+        self._counters = {}
+
+    def timer(self, name):
+        """Get context manager which adds its time to the timer.
+
+        Keyword arguments:
+        name -- name of the timer (stage).
+        """
+        if not self._enabled:
+            return self._null
+        return self._timing(name)
+
+    @contextlib.contextmanager
+    def _timing(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator of functions which adds their time to the timer.
+
+        Keyword arguments:
+        name -- name of the timer (stage).
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self._enabled:
+                    return func(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.addTime(name, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def addTime(self, name, seconds):
+        """Add time to the timer.
+
+        Keyword arguments:
+        name -- name of the timer (stage);
+        seconds -- time of the stage.
+        """
+        calls, total = self._timers.get(name, (0, 0.))
+        self._timers[name] = (calls + 1, total + seconds)
+
+    def count(self, name, value=1):
+        """Add value to the counter (if metrics are enabled).
+
+        Keyword arguments:
+        name -- name of the counter;
+        value -- increment.
+        """
+        if self._enabled:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """Get dictionary of timers (calls and seconds) and counters."""
+        return {
+            'timers': dict(
+                (name, {'calls': calls, 'seconds': seconds})
+                for name, (calls, seconds) in self._timers.items()),
+            'counters': dict(self._counters)}
+
+    def merge(self, summary):
+        """Add metrics of the summary (of other process).
+
+        Keyword arguments:
+        summary -- dictionary of summary method.
+        """
+        for name, timer in summary['timers'].items():
+            calls, total = self._timers.get(name, (0, 0.))
+            self._timers[name] = (
+                calls + timer['calls'], total + timer['seconds'])
+        for name, value in summary['counters'].items():
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def save(self, fname, files=None):
+        """Save run summary and summaries of files in JSON file.
+
+        Keyword arguments:
+        fname -- name of the JSON file;
+        files -- dictionary of summaries of files by names.
+        """
+        with open(fname, 'w') as f:
+            json.dump(
+                {'run': self.summary(), 'files': files or {}}, f, indent=2)
+
+    def report(self):
+        "Get text table of timers and counters."
+        lines = []
+        for name, (calls, seconds) in sorted(
+                self._timers.items(), key=lambda item: -item[1][1]):
+            lines.append('{:24} {:10d} calls {:10.3f} s'.format(
+                name, calls, seconds))
+        for name, value in sorted(self._counters.items()):
+            lines.append('{:24} {:16}'.format(name, value))
+
+        return '\n'.join(lines)
+
+
+# Metrics of this process.
+metrics = parusMetrics()
@@ -0,0 +1,446 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming statistics for blocks of Parus data.
+"""
+import numpy as np
+
+import parusMetrics as pm
+
+
+def meanStdTheresholds(arr, factor=1.):
+    """Get theresholds mean + factor * std along the last axis.
+
+    Keyword arguments:
+    arr -- array of values, lines are along the last axis;
+    factor -- multiplier of standard deviation.
+    """
+    return np.mean(arr, axis=-1) + factor * np.std(arr, axis=-1)
+
+
+def iqrTheresholds(arr, factor=1.5):
+    """Get theresholds Q3 + factor * (Q3 - Q1) along the last axis.
+
+    Quartiles are found by np.partition (selection without the full
+    sort of lines).
+
+    Keyword arguments:
+    arr -- array of values, lines are along the last axis;
+    factor -- multiplier of interquartile range (1.5 for minor and
+    3 for major outliers).
+    """
+    n = arr.shape[-1]
+    i_q1 = max(n // 4 - 1, 0)
+    i_q3 = max(3 * n // 4 - 1, 0)
+    part = np.partition(arr, (i_q1, i_q3), axis=-1)
+    q1 = part[..., i_q1]
+    q3 = part[..., i_q3]
+
+    return q3 + factor * (q3 - q1)
+
+
+def madTheresholds(arr, factor=3.):
+    """Get theresholds median + factor * sigma along the last axis.
+
+    Sigma is estimated by the median absolute deviation (MAD * 1.4826
+    for normal distribution).
+
+    Keyword arguments:
+    arr -- array of values, lines are along the last axis;
+    factor -- multiplier of sigma.
+    """
+    median = np.median(arr, axis=-1, keepdims=True)
+    mad = np.median(np.abs(arr - median), axis=-1)
+
+    return median[..., 0] + factor * 1.4826 * mad
+
+
+# functions of theresholds by names of methods
+theresholdMethods = {
+    'std': meanStdTheresholds,
+    'iqr': iqrTheresholds,
+    'mad': madTheresholds}
+
+
+class streamMoments(object):
+    """Running mean and variance of equally shaped arrays.
+
+    Blocks are merged by the Welford/Chan pairwise formulas, so the
+    data is read once and the result is numerically stable for any
+    number of units.
+    """
+
+    def __init__(self, ignoreNaN=False):
+        """Init empty accumulator.
+
+        Keyword arguments:
+        ignoreNaN -- skip NaN values (count of values is kept
+        for every element separately).
+        """
+        super().__init__()
+        self._ignoreNaN = ignoreNaN
+        self._count = 0
+        self._mean = None
+        self._m2 = None
+
+    # property BEGIN
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        if self._mean is None:
+            return None
+        return self._finalize(self._mean)
+
+    @property
+    def variance(self):
+        """Population variance (ddof=0)."""
+        if self._m2 is None:
+            return None
+        return self._finalize(self._m2 / np.maximum(self._count, 1))
+
+    @property
+    def std(self):
+        """Population standard deviation (ddof=0)."""
+        if self._m2 is None:
+            return None
+        return np.sqrt(self.variance)
+
+    @property
+    def sigma(self):
+        """Sample standard deviation (ddof=1)."""
+        if self._m2 is None:
+            return None
+        return self._finalize(
+            np.sqrt(self._m2 / np.maximum(self._count - 1, 1)), 1)
+
+    @property
+    def rms(self):
+        """Root mean square of values."""
+        if self._m2 is None:
+            return None
+        return np.sqrt(self.mean**2 + self.variance)
+    # property END
+
+    def _finalize(self, arr, ddof=0):
+        """Set NaN for elements with too few values."""
+        if np.ndim(self._count) or self._count <= ddof:
+            arr = np.where(self._count > ddof, arr, np.nan)
+        return arr
+
+    @pm.metrics.timed('reduce')
+    def update(self, block):
+        """Merge block of values into the accumulator.
+
+        Keyword arguments:
+        block -- array of values, the first axis is the axis of units
+        (float32 blocks are reduced in single precision, running sums
+        are kept in double precision).
+        """
+        block = np.asarray(block)
+        if block.dtype.kind != 'f':
+            block = block.astype(float)
+        if self._ignoreNaN:
+            valid = ~np.isnan(block)
+            n_b = np.count_nonzero(valid, axis=0)
+            sum_b = np.sum(block, axis=0, where=valid)
+            mean_b = sum_b / np.maximum(n_b, 1)
+            dev = np.where(valid, block - mean_b, 0)
+        else:
+            n_b = block.shape[0]
+            if not n_b:
+                return
+            mean_b = np.mean(block, axis=0)
+            dev = block - mean_b
+        m2_b = np.einsum('i...,i...->...', dev, dev).astype(float)
+        mean_b = np.asarray(mean_b, dtype=float)
+
+        if self._mean is None:
+            self._count = n_b
+            self._mean = mean_b
+            self._m2 = m2_b
+            return
+
+        n_a = self._count
+        n = n_a + n_b
+        delta = mean_b - self._mean
+        ratio = n_b / np.maximum(n, 1)
+        self._mean = self._mean + delta * ratio
+        self._m2 = self._m2 + m2_b + delta**2 * n_a * ratio
+        self._count = n
+
+
+class hardAccumulator(object):
+    """Streaming version of parusFile.HardCalculation.
+
+    Only running sums for frequencies and reflections are kept,
+    so memory depends on the block size but not on the file length.
+    """
+
+    def __init__(self, owner):
+        """Init empty accumulator.
+
+        Keyword arguments:
+        owner -- parusFile object which gives blocks of units.
+        """
+        super().__init__()
+        self._owner = owner
+        self._ranges = owner.getIntervalRanges()
+
+        self._amplitudes = streamMoments(ignoreNaN=True)
+        self._powers = streamMoments(ignoreNaN=True)
+        self._heights = streamMoments(ignoreNaN=True)
+        self._noise = streamMoments()
+        self._noise_powers = streamMoments()
+        # absorbtion accumulators
+        self._rho_sum = 0
+        self._rho_count = 0
+        self._counts = 0
+
+    def update(self, arr_abs, arr_c):
+        """Merge block of units into the accumulator.
+
+        Keyword arguments:
+        arr_abs, arr_c -- magnitudes and complex amplitudes of block.
+        """
+        s_plus_n, heights, noise = self._owner.getHardReflections(
+            arr_abs, arr_c, self._ranges)
+        s_abs = np.abs(s_plus_n)
+        n_abs = np.abs(noise)
+
+        self._amplitudes.update(s_abs)
+        self._powers.update(s_abs**2)
+        self._heights.update(heights)
+        self._noise.update(n_abs)
+        self._noise_powers.update(n_abs**2)
+
+        # std of the single noise point
+        noise_std = np.std(noise[:, :, np.newaxis], axis=-1)
+        rho = self._owner.getAbsorption(s_plus_n, noise_std)
+        is_rho = ~np.isnan(rho)
+        self._rho_sum = self._rho_sum + np.sum(rho, axis=0, where=is_rho)
+        self._rho_count = self._rho_count + np.count_nonzero(is_rho, axis=0)
+        self._counts = self._counts + np.count_nonzero(
+            ~np.isnan(heights[:, :, 1]), axis=0)
+
+    def result(self):
+        """Get results in the format of parusFile.HardCalculation."""
+        n_refs = self._ranges.shape[1]
+        n_2 = self._noise_powers.mean[:, np.newaxis]
+        n_std = self._noise.std[:, np.newaxis]
+
+        results = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            results['A_eff'] = np.sqrt(self._powers.mean - n_2)
+            results['A_std'] = self._amplitudes.std
+            results['n_std'] = np.repeat(n_std, n_refs, axis=1)
+            results['h_eff'] = self._heights.mean
+            results['h_std'] = self._heights.std
+
+            rho_mean = np.where(
+                self._rho_count > 0,
+                self._rho_sum / np.maximum(self._rho_count, 1),
+                np.nan)
+            results['L_mean'] = 20 * np.log10(rho_mean)
+        results['counts'] = np.asarray(self._counts, dtype=float)
+
+        return results
+
+
+class profileAccumulator(object):
+    """Streaming version of parusFile.getStatistics.
+
+    Mean, rms and sigma of magnitudes are kept for all frequencies and
+    heights, so sigma does not need the second pass of the file.
+    """
+
+    def __init__(self, owner):
+        """Init empty accumulator.
+
+        Keyword arguments:
+        owner -- parusFile object which gives blocks of units.
+        """
+        super().__init__()
+        self._owner = owner
+        self._moments = streamMoments()
+
+    def update(self, arr_abs, arr_c):
+        """Merge block of units into the accumulator.
+
+        Keyword arguments:
+        arr_abs, arr_c -- magnitudes and complex amplitudes of block.
+        """
+        self._moments.update(arr_abs)
+
+    def result(self):
+        """Get results in the format of parusFile.getStatistics.
+
+        Profiles are filled by NaN if there were no units.
+        """
+        if not self._moments.count:
+            shape = (self._owner.frqs.size, self._owner.heights.size)
+            peaks = (shape[0], self._owner.intervals.shape[1])
+            return {
+                'mean': np.full(shape, np.NaN),
+                'rms': np.full(shape, np.NaN),
+                'sigma': np.full(shape, np.NaN),
+                'heights': np.full(peaks, np.NaN),
+                'amplitudes': np.full(peaks, np.NaN)}
+
+        rms = self._moments.rms
+        heights, amplitudes = self._owner.getIntervalPeaks(rms)
+
+        return {
+            'mean': self._moments.mean,
+            'rms': rms,
+            'sigma': self._moments.sigma,
+            'heights': heights,
+            'amplitudes': amplitudes}
+
+
+class spectralAccumulator(object):
+    """Streaming version of parusFile.SpectralCalculation.
+
+    Complex amplitudes of found reflections are kept for units (the size
+    of the result). Gaps of reflections are filled while blocks come:
+    for missed reflection only the window of heights of its interval is
+    kept until the next found index, trailing gaps are filled in result.
+    Only blocks given to update are used, so every unit is decoded once.
+    """
+
+    def __init__(self, owner):
+        """Init empty accumulator.
+
+        Keyword arguments:
+        owner -- parusFile object which gives blocks of units.
+        """
+        super().__init__()
+        self._owner = owner
+
+        # heights intervals of two reflections
+        ranges = owner.getIntervalRanges()[:, 0:2]
+        n_frqs = ranges.shape[0]
+
+        # windows of heights with all parts of intervals (filled index
+        # is between found indexes, so it is inside the window)
+        is_part = ranges[..., 1] > ranges[..., 0]
+        n_heights = owner.heights.size
+        low = np.min(np.where(is_part, ranges[..., 0], n_heights), axis=-1)
+        high = np.max(np.where(is_part, ranges[..., 1], 0), axis=-1)
+        low = np.where(np.any(is_part, axis=-1), low, 0)
+        self._width = max(int(np.max(high - low)), 1)
+        self._low = np.minimum(low, n_heights - self._width).ravel()
+        self._ranges = ranges
+
+        # last found indexes of reflections
+        self._last = np.full((n_frqs, 2), -9999)
+
+        # blocks of noise, indexes and signal (empty blocks set shapes)
+        complexType = owner.precisions[owner.precision][1]
+        self._noise = [np.empty((0, n_frqs), complexType)]
+        self._indexes = [np.empty((0, n_frqs, 2), dtype=int)]
+        self._signal = [np.empty((0, n_frqs, 2), np.complex64)]
+
+        # missed reflections without the next found index: block number,
+        # units and reflections (flat frequency and reflection numbers)
+        # of the block and windows of heights
+        self._gaps = []
+
+    def fillGaps(self, is_fill, fill):
+        """Fill pending gaps of reflections by their windows.
+
+        Keyword arguments:
+        is_fill -- mask of reflections with known filled index;
+        fill -- filled indexes of reflections.
+        """
+        is_fill = is_fill.ravel()
+        fill = fill.ravel()
+        gaps = []
+        for k, units, refs, windows in self._gaps:
+            done = is_fill[refs]
+            if np.any(done):
+                u = units[done]
+                r = refs[done]
+                # views of the block with flat reflections
+                indexes = self._indexes[k].reshape(
+                    self._indexes[k].shape[0], -1)
+                signal = self._signal[k].reshape(indexes.shape)
+                indexes[u, r] = fill[r]
+                signal[u, r] = windows[done, fill[r] - self._low[r]]
+            if not np.all(done):
+                pending = ~done
+                gaps.append(
+                    (k, units[pending], refs[pending], windows[pending]))
+        self._gaps = gaps
+
+    def update(self, arr_abs, arr_c):
+        """Merge block of units into the accumulator.
+
+        Keyword arguments:
+        arr_abs, arr_c -- magnitudes and complex amplitudes of block.
+        """
+        # last point of heights (copy, the view keeps the whole block)
+        self._noise.append(arr_c[:, :, -1].copy())
+        thr = self._owner.getTheresholds(arr_abs)
+
+        # get indexes for reflections
+        found = self._owner.getReflectionIndexes(
+            arr_abs, thr, self._ranges)
+        is_found = found >= 0
+
+        # found indexes after the pending gaps fill them
+        is_first = np.any(is_found, axis=0)
+        first = np.take_along_axis(
+            found, np.argmax(is_found, axis=0)[np.newaxis], axis=0)[0]
+        self.fillGaps(is_first, np.where(
+            self._last >= 0,
+            np.rint((self._last + first) / 2).astype(int), first))
+
+        # gaps inside the block (and its leading gaps) are filled
+        # with the last found index before the block
+        filled = self._owner.fillIndexesGaps(
+            np.concatenate((self._last[np.newaxis], found)))[1:]
+        is_next = np.logical_or.accumulate(is_found[::-1], axis=0)[::-1]
+        indexes = np.where(is_next, filled, -9999)
+        # amplitudes of reflections (np.int16 quadratures are exact)
+        signal = np.take_along_axis(
+            arr_c, np.maximum(indexes, 0), axis=-1).astype(np.complex64)
+
+        # trailing gaps of the block wait for the next found indexes
+        units, refs = np.nonzero(~is_next.reshape(found.shape[0], -1))
+        if units.size:
+            heights = self._low[refs, np.newaxis] + np.arange(self._width)
+            windows = arr_c[
+                units[:, np.newaxis], refs[:, np.newaxis] // 2, heights]
+            self._gaps.append((
+                len(self._indexes), units, refs,
+                windows.astype(np.complex64)))
+
+        self._indexes.append(indexes)
+        self._signal.append(signal)
+        last = np.take_along_axis(
+            found, found.shape[0] - 1 -
+            np.argmax(is_found[::-1], axis=0)[np.newaxis], axis=0)[0]
+        self._last = np.where(is_first, last, self._last)
+
+    def result(self):
+        """Get results in the format of parusFile.SpectralCalculation."""
+        # trailing gaps get the last found index
+        self.fillGaps(self._last >= 0, self._last)
+
+        indexes = np.concatenate(self._indexes)
+        signal = np.concatenate(self._signal)
+
+        # set "bad signal" rather NaN
+        # (NaN only for frequencies without any reflection)
+        is_ref = indexes >= 0
+        s_plus_n = np.where(is_ref, signal, np.NaN)
+        heights = np.where(
+            is_ref, self._owner.heights[np.where(is_ref, indexes, 0)], np.NaN)
+
+        return {
+            'signal': s_plus_n,
+            'noise': np.concatenate(self._noise),
+            'h_eff': np.mean(heights, 0),
+            'h_std': np.std(heights, 0)}
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Parus data files (.frq and .ion) for tests and benchmarks.
+"""
+import argparse
+import struct
+import time
+
+import numpy as np
+
+import parusFile as pf
+
+
+def createParser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'name',
+        help='name of the created file (.frq or .ion)')
+    parser.add_argument(
+        '-v', '--version',
+        type=int, default=1, choices=(0, 1, 2),
+        help='version of the .frq file header')
+    parser.add_argument(
+        '-n', '--frequencies',
+        type=int, default=5,
+        help='number of frequencies')
+    parser.add_argument(
+        '-H', '--heights',
+        type=int, default=256,
+        help='number of heights (.frq version 1 and .ion)')
+    parser.add_argument(
+        '-u', '--units',
+        type=int, default=1000,
+        help='number of units (.frq)')
+    parser.add_argument(
+        '--seed',
+        type=int, default=0,
+        help='seed of the random generator')
+
+    return parser
+
+
+def frqHeader(version=1, frqs=(1600, 1800, 2000, 2200, 2500),
+              count_height=256, height_step=1500, height_min=60,
+              height_max=160, pulse_frq=100, tm=None):
+    """Get header of .frq file (array of pf.headerDtype) and frequencies.
+
+    Keyword arguments:
+    version -- version of the header (0, 1 or 2);
+    frqs -- sounding frequencies, kHz;
+    count_height -- number of heights (version 1);
+    height_step -- heights step, m;
+    height_min, height_max -- heights of the first reflection range,
+    km (versions 0 and 2);
+    pulse_frq -- switching frequency, Hz;
+    tm -- time.struct_time of sounding beginning (now if None).
+    """
+    if tm is None:
+        tm = time.gmtime()
+    hdr = np.zeros(1, dtype=pf.headerDtype)
+    hdr['ver'] = version
+    t = hdr['time']
+    t['year'] = tm.tm_year - 1900
+    t['mon'] = tm.tm_mon - 1
+    t['mday'] = tm.tm_mday
+    t['hour'] = tm.tm_hour
+    t['min'] = tm.tm_min
+    t['sec'] = tm.tm_sec
+    t['wday'] = (tm.tm_wday + 1) % 7
+    t['yday'] = tm.tm_yday - 1
+    hdr['time'] = t
+    hdr['height_min'] = height_min
+    hdr['height_max'] = height_max
+    hdr['height_step'] = height_step
+    hdr['count_height'] = count_height
+    hdr['count_modules'] = len(frqs)
+    hdr['pulse_frq'] = pulse_frq
+
+    return hdr, np.asarray(frqs, dtype=np.uint32)
+
+
+def reflectionProfiles(heights, n_frqs, units, amplitude=3000.,
+                       width=2., loss=0.2, rng=None):
+    """Get magnitudes of two reflections for all units.
+
+    Reflection heights move slowly with time, reflections are lost
+    randomly (the second one more often).
+
+    Keyword arguments:
+    heights -- array of heights, km;
+    n_frqs -- number of frequencies;
+    units -- number of units;
+    amplitude -- amplitude of the first reflection;
+    width -- width of reflection, km;
+    loss -- probability to lose the first reflection in unit;
+    rng -- numpy random Generator.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    times = np.arange(units)[:, np.newaxis, np.newaxis]
+    profiles = np.zeros((units, n_frqs, heights.size))
+    for i_frq in range(n_frqs):
+        h0 = 100 + 5 * i_frq
+        for i_ref in range(2):
+            h = (i_ref + 1) * h0 + 2 * np.sin(times[:, 0] / 10)
+            shape = np.exp(-((heights - h) / width)**2)
+            keep = rng.random((units, 1)) > loss * (i_ref + 1)
+            profiles[:, i_frq, :] += amplitude / (i_ref + 1) * shape * keep
+
+    return profiles
+
+
+def writeFrq(fname, version=1, frqs=(1600, 1800, 2000, 2200, 2500),
+             count_height=256, units=1000, noise=200., amplitude=3000.,
+             seed=0, blockSize=256, **kwargs):
+    """Write synthetic .frq file with reflections and noise.
+
+    Return number of written bytes.
+
+    Keyword arguments:
+    fname -- name of the file;
+    version -- version of the header (0, 1 or 2);
+    frqs -- sounding frequencies, kHz;
+    count_height -- number of heights (version 1);
+    units -- number of units;
+    noise -- standard deviation of quadratures noise;
+    amplitude -- amplitude of the first reflection;
+    seed -- seed of the random generator;
+    blockSize -- number of units generated at once;
+    kwargs -- other arguments of frqHeader.
+    """
+    rng = np.random.default_rng(seed)
+    hdr, frqs = frqHeader(version, frqs, count_height, **kwargs)
+    heights = pf.headerHeights(hdr)
+
+    with open(fname, 'wb') as f:
+        hdr.tofile(f)
+        frqs.tofile(f)
+        for start in range(0, units, blockSize):
+            n = min(blockSize, units - start)
+            magnitudes = reflectionProfiles(
+                heights, frqs.size, n, amplitude, rng=rng)
+            phases = rng.uniform(0, 2 * np.pi, magnitudes.shape)
+            quadratures = np.empty(magnitudes.shape + (2,))
+            quadratures[..., 0] = magnitudes * np.cos(phases)
+            quadratures[..., 1] = magnitudes * np.sin(phases)
+            quadratures += rng.normal(0, noise, quadratures.shape)
+            # two low bits are the channel information
+            raw = np.clip(np.rint(quadratures), -8000, 8000).astype(np.int16)
+            raw = np.left_shift(raw, 2) | rng.integers(
+                0, 4, raw.shape, dtype=np.int16)
+            raw.reshape(n, frqs.size, -1).tofile(f)
+        size = f.tell()
+
+    return size
+
+
+def writeIon(fname, count_freq=400, count_height=512, height_min=0,
+             height_step=1500, freq_min=1000, freq_max=15000,
+             outliers=3, seed=0, tm=None, outliers_x=0, overflow=False):
+    """Write synthetic .ion ionogram with random outliers.
+
+    Return number of written bytes.
+
+    Keyword arguments:
+    fname -- name of the file;
+    count_freq -- number of frequency lines;
+    count_height -- number of heights;
+    height_min -- beginning height, m;
+    height_step -- heights step, m;
+    freq_min, freq_max -- frequency range, kHz;
+    outliers -- maximal number of outliers (O component) in a line;
+    seed -- seed of the random generator;
+    tm -- time.struct_time of sounding (now if None);
+    outliers_x -- maximal number of outliers of X component in a line;
+    overflow -- the first and the last outliers of lines can cross
+    the bounds of heights (below only if height_min allows it).
+    """
+    rng = np.random.default_rng(seed)
+    if tm is None:
+        tm = time.gmtime()
+    frqs = np.linspace(freq_min, freq_max, count_freq).astype(np.uint16)
+
+    chunks = [struct.pack(
+        '=I 9i 8I', 0,
+        tm.tm_sec, tm.tm_min, tm.tm_hour, tm.tm_mday, tm.tm_mon - 1,
+        tm.tm_year - 1900, (tm.tm_wday + 1) % 7, tm.tm_yday - 1, 0,
+        height_min, height_step, count_height, 1,
+        freq_min, freq_max, count_freq, 1)]
+    for frq in frqs:
+        count_o = int(rng.integers(0, outliers + 1))
+        count_x = int(rng.integers(0, outliers_x + 1)) if outliers_x else 0
+        # not overlapped outliers in separate parts of heights
+        part = count_height // max(count_o, 1)
+        lines = []
+        for i in range(count_o + count_x):
+            if i < count_o:
+                count = int(rng.integers(1, min(part, 64)))
+                begin = i * part + int(rng.integers(0, part - count + 1))
+                if overflow and i == 0:
+                    begin = max(begin - count // 2, -height_min // height_step)
+                elif overflow and i == count_o - 1:
+                    begin += count // 2
+            else:  # X component anywhere
+                count = int(rng.integers(1, 64))
+                begin = int(rng.integers(0, count_height - count + 1))
+            lines.append(struct.pack(
+                '=L H', height_min + begin * height_step, count))
+            lines.append(rng.integers(
+                1, 256, count, dtype=np.uint8).tobytes())
+        chunks.append(struct.pack(
+            '=3H 7B', int(frq), 0, 10, 100, 40, 0, 30, 30, count_o, count_x))
+        chunks.extend(lines)
+
+    data = b''.join(chunks)
+    with open(fname, 'wb') as f:
+        f.write(data)
+
+    return len(data)
+
+
+if __name__ == '__main__':
+    parser = createParser()
+    namespace = parser.parse_args()
+
+    if namespace.name.lower().endswith('.ion'):
+        size = writeIon(
+            namespace.name,
+            count_freq=namespace.frequencies,
+            count_height=namespace.heights,
+            seed=namespace.seed)
+    else:
+        size = writeFrq(
+            namespace.name,
+            version=namespace.version,
+            frqs=1600 + 200 * np.arange(namespace.frequencies),
+            count_height=namespace.heights,
+            units=namespace.units,
+            seed=namespace.seed)
+    print('{} bytes written to {}'.format(size, namespace.name))
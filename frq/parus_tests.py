@@ -0,0 +1,1012 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of Parus data processing on synthetic files.
+
+Vectorized paths are compared with the original per-line logic (see
+line* functions). Run from this directory:
+python -m unittest parus_tests
+"""
+from datetime import datetime
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+import parusBatch as pb
+import parusBench as pbench
+import parusCatalog as pc
+import parusDB as pdb
+import parusFile as pf
+import parusStats as ps
+import parusSynth as syn
+
+# directory of this module (databases shipped with the repository)
+moduleDirectory = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.append(os.path.join(moduleDirectory, '..', 'ion'))
+try:
+    import iview3
+except ImportError:  # it needs matplotlib
+    iview3 = None
+
+
+def synthFile(directory, version=1, units=100, **options):
+    """Write synthetic .frq file and get its name.
+
+    Keyword arguments:
+    directory -- directory of the file;
+    version -- version of the header (0, 1 or 2);
+    units -- number of units;
+    options -- other arguments of parusSynth.writeFrq.
+    """
+    fname = os.path.join(directory, 'synth_v{}.frq'.format(version))
+    syn.writeFrq(fname, version=version, units=units, seed=version, **options)
+
+    return fname
+
+
+def lineReflectionIndex(heights, intervals, arr, thereshold):
+    """Get reflections indexes for line by the original per-line search.
+
+    Keyword arguments:
+    heights -- heights of the file;
+    intervals -- heights intervals of reflections of the frequency;
+    arr -- magnitudes of the line;
+    thereshold -- thereshold of the line.
+    """
+    n_refs = intervals.shape[0]
+    indexes = np.full(n_refs, -9999)  # special no-value key
+
+    i_ampl = np.nonzero(arr >= thereshold)[0]
+    if i_ampl.size:
+        for i in range(n_refs):
+            i_min = i_ampl[np.nonzero(heights[i_ampl] >= intervals[i, 0])[0]]
+            if i_min.size:
+                i_max = i_min[np.nonzero(heights[i_min] <= intervals[i, 1])[0]]
+                if i_max.size:
+                    ind = np.argmax(arr[i_max])
+                    indexes[i] = i_max[ind]
+                else:
+                    break
+            else:
+                break
+
+    return indexes
+
+
+def lineFillGaps(iarr):
+    """Fill gaps of reflections indexes by the original loop over times.
+
+    Keyword arguments:
+    iarr -- indexes of the reflection for times (-9999 for missed).
+    """
+    iarr = iarr.copy()
+    n_times = iarr.size
+    indBeg = 0
+    indEnd = 0
+    key = 0
+    for k in range(n_times):
+        if iarr[k] < 0:
+            if key == 0:
+                indBeg = k
+                key = 1
+            indEnd = k
+            if indEnd < n_times - 1:
+                continue
+
+        if key == 1:
+            if indBeg == 0:
+                indMean = iarr[k]
+            elif indEnd == n_times - 1:
+                indMean = iarr[indBeg - 1]
+            else:
+                indMean = np.rint((iarr[indBeg - 1] + iarr[k]) / 2)
+
+            iarr[indBeg:indEnd + 1] = int(indMean)
+            key = 0
+
+    return iarr
+
+
+def lineIndexes(A, arr_abs):
+    """Get reflections indexes of the unit by the original per-line search.
+
+    Keyword arguments:
+    A -- parusFile object;
+    arr_abs -- magnitudes of the unit.
+    """
+    return np.array([
+        lineReflectionIndex(
+            A.heights, A.intervals[j], arr,
+            np.mean(arr) + np.std(arr))
+        for j, arr in enumerate(arr_abs)])
+
+
+def lineUnitIndexes(A, i):
+    """Get magnitudes, complex amplitudes and reflections indexes
+    of the unit by the original per-line search.
+
+    Keyword arguments:
+    A -- parusFile object;
+    i -- number of the unit.
+    """
+    arr_abs, arr_c = A.getUnit(i)
+
+    return arr_abs, arr_c, lineIndexes(A, arr_abs)
+
+
+def lineHardCalculation(A):
+    """Get results of HardCalculation by the original per-line loops.
+
+    Keyword arguments:
+    A -- parusFile object.
+    """
+    n_frqs, n_refs = A.intervals.shape[:2]
+    shape = [A.units, n_frqs, n_refs]
+    heights = np.full(shape, np.NaN)
+    s_plus_n = np.full(shape, np.NaN, complex)
+    noise = np.full(shape, np.NaN, complex)
+    noise_std = np.zeros([A.units, n_frqs])
+    for i in range(A.units):
+        arr_abs, arr_c, indexes = lineUnitIndexes(A, i)
+        for j in range(n_frqs):
+            idxs = indexes[j]
+            i_in = np.extract(idxs > 0, idxs)
+            i_to = np.nonzero(idxs > 0)[0]
+            s_plus_n[i, j, i_to] = arr_c[j, i_in]
+            noise[i, j, :] = arr_c[j, -1]
+            heights[i, j, i_to] = A.heights[i_in]
+            noise_std[i, j] = np.std(arr_c[j, -1])
+
+    results = {}
+    results['A_eff'] = np.sqrt(
+        np.nanmean(np.abs(s_plus_n)**2, 0) - np.mean(np.abs(noise)**2, 0))
+    results['A_std'] = np.nanstd(np.abs(s_plus_n), 0)
+    results['n_std'] = np.nanstd(np.abs(noise), 0)
+    results['h_eff'] = np.nanmean(heights, 0)
+    results['h_std'] = np.nanstd(heights, 0)
+
+    rho = np.full([A.units, n_frqs], np.NaN)
+    counts = np.zeros(n_frqs)
+    for j in range(n_frqs):
+        i_times = np.nonzero(~np.isnan(np.real(s_plus_n[:, j, 1])))[0]
+        n_std = noise_std[i_times, j]
+        counts[j] = i_times.size
+        A1 = np.sqrt(np.abs(s_plus_n[i_times, j, 0])**2 - n_std**2)
+        A2 = np.sqrt(np.abs(s_plus_n[i_times, j, 1])**2 - n_std**2)
+        rho[i_times, j] = 2 * A2 / A1
+    results['L_mean'] = 20 * np.log10(np.nanmean(rho, 0))
+    results['counts'] = counts
+
+    return results
+
+
+def lineSpectralCalculation(A, arr_c=None):
+    """Get results of SpectralCalculation by the original per-line loops.
+
+    Lines without reflections get NaN.
+
+    Keyword arguments:
+    A -- parusFile object;
+    arr_c -- complex amplitudes of all units (units of A if None).
+    """
+    if arr_c is None:
+        arr_c = A.getUnits(0, A.units)[1]
+    n_times, n_frqs = arr_c.shape[:2]
+    noise = np.empty([n_times, n_frqs], complex)
+    indexes = np.empty([n_times, n_frqs, 2], dtype=int)
+    for i in range(n_times):
+        noise[i] = arr_c[i, :, -1]
+        indexes[i] = lineIndexes(A, np.abs(arr_c[i]))[:, 0:2]
+
+    for j in range(n_frqs):
+        for k in range(2):
+            indexes[:, j, k] = lineFillGaps(indexes[:, j, k])
+
+    s_plus_n = np.full([n_times, n_frqs, 2], np.NaN, complex)
+    heights = np.full([n_times, n_frqs, 2], np.NaN)
+    for i in range(n_times):
+        for j in range(n_frqs):
+            for k in range(2):
+                if indexes[i, j, k] >= 0:
+                    s_plus_n[i, j, k] = arr_c[i, j, indexes[i, j, k]]
+                    heights[i, j, k] = A.heights[indexes[i, j, k]]
+
+    return {
+        'signal': s_plus_n,
+        'noise': noise,
+        'h_eff': np.mean(heights, 0),
+        'h_std': np.std(heights, 0)}
+
+
+def lineIqrThereshold(arr, factor=1.5):
+    """Get thereshold of the line by the original quartiles of the sort.
+
+    Keyword arguments:
+    arr -- magnitudes of the line;
+    factor -- multiplier of interquartile range.
+    """
+    arrSorted = np.sort(arr, axis=0, kind='mergesort')
+    n = arrSorted.size
+    Q1 = np.amin((arrSorted[n//4], arrSorted[n//4-1]))
+    Q3 = np.amin((arrSorted[3*n//4], arrSorted[3*n//4-1]))
+
+    return Q3 + factor * (Q3 - Q1)
+
+
+def lineMadThereshold(arr, factor=3.):
+    """Get thereshold median + factor * 1.4826 * MAD of the line.
+
+    Keyword arguments:
+    arr -- magnitudes of the line;
+    factor -- multiplier of sigma.
+    """
+    median = np.median(arr)
+
+    return median + factor * 1.4826 * np.median(np.abs(arr - median))
+
+
+def lineReadIon(fname):
+    """Read ionogram by the original per-byte parser.
+
+    Return parameters, data and frequencies as iview3.readDataFile.
+    Outliers of X component are skipped, samples out of heights are
+    dropped.
+
+    Keyword arguments:
+    fname -- name of the .ion file.
+    """
+    with open(fname, 'rb') as fid:
+        properties = iview3.readFileHeader(fid)
+        count_height = properties['count_height']
+        dh = properties['height_step']
+        h0 = properties['height_min']
+        data = np.zeros(
+            (count_height, properties['count_freq']), dtype=np.uint8)
+        frqs = np.zeros(properties['count_freq'], dtype=int)
+        i = 0
+        while True:
+            headerLine = iview3.readFrequencyHeader(fid)
+            if not headerLine:
+                break
+            count_o = headerLine['count_o']
+            for j in range(count_o + headerLine['count_x']):
+                headerOutlier = iview3.readOutlierHeader(fid)
+                ind = (headerOutlier['height_begin'] - h0)//dh
+                for k in range(headerOutlier['count_samples']):
+                    x = ord(fid.read(1))
+                    if j < count_o and 0 <= ind + k < count_height:
+                        data[ind + k, i] = x
+            frqs[i] = headerLine['frequency']
+            i = i + 1
+
+    return {'params': properties, 'data': data, 'frqs': frqs}
+
+
+def lineAddHardResults(cur, info, results):
+    """Save results of HardCalculation by the original row-by-row path.
+
+    Keyword arguments:
+    cur -- cursor of the database;
+    info -- dictionary with name, time, dt, dh and frqs of the file;
+    results -- results of parusFile.HardCalculation.
+    """
+    cur.execute(
+        'SELECT id_file FROM files WHERE filename=?', (info['name'],))
+    data = cur.fetchall()
+    if data:  # exist
+        file_id = data[0][0]
+    else:  # create record
+        cur.execute(
+            'insert into files '
+            '(filename, time, dt, dh) values (?,?,?,?)',
+            (info['name'], info['time'], info['dt'], info['dh']))
+        file_id = cur.lastrowid
+
+    frq_ids = []
+    for frq in info['frqs']:
+        cur.execute(
+            'SELECT id_frq FROM frequencies '
+            'WHERE frequency=?', (int(frq),))
+        data = cur.fetchall()
+        if data:  # exist
+            frq_ids.append(data[0][0])
+        else:  # create record
+            cur.execute(
+                'INSERT INTO frequencies '
+                '(frequency) values (?)', (int(frq),))
+            frq_ids.append(cur.lastrowid)
+
+    for i_frq, frq_id in enumerate(frq_ids):
+        cur.execute(
+            'SELECT id_ampl FROM amplitudes '
+            'WHERE ampl_file=? AND ampl_frq=?', (file_id, frq_id))
+        if not cur.fetchall():  # create records
+            for i_ref in range(results['A_eff'].shape[1]):
+                if np.isnan(results['A_eff'][i_frq, i_ref]):
+                    break
+                if results['A_std'][i_frq, i_ref] == 0:
+                    break
+                cur.execute(
+                    'INSERT INTO amplitudes '
+                    '(ampl_file, ampl_frq, number, '
+                    'a_eff, a_std, n_std, h_eff, h_std ) '
+                    'VALUES(?,?,?,?,?,?,?,?)',
+                    (file_id, frq_id, i_ref,
+                     results['A_eff'][i_frq, i_ref],
+                     results['A_std'][i_frq, i_ref],
+                     results['n_std'][i_frq, i_ref],
+                     results['h_eff'][i_frq, i_ref],
+                     results['h_std'][i_frq, i_ref]))
+
+        if results['counts'][i_frq]:
+            cur.execute(
+                'UPDATE amplitudes SET L_mean = ?, counts = ? '
+                'WHERE ampl_file = ? AND ampl_frq = ? AND number = 1',
+                (results['L_mean'][i_frq], results['counts'][i_frq],
+                 file_id, frq_id))
+
+
+class SynthTestCase(unittest.TestCase):
+    """Test case with synthetic files of all versions of the header.
+
+    Files are written once for the test case class into the temporary
+    directory, self.files are their names by versions.
+    """
+
+    versions = (0, 1, 2)
+    units = 100
+
+    @classmethod
+    def setUpClass(cls):
+        cls._temporary = tempfile.TemporaryDirectory()
+        cls.directory = cls._temporary.name
+        cls.files = dict(
+            (version, synthFile(cls.directory, version, cls.units))
+            for version in cls.versions)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._temporary.cleanup()
+
+    def assertSameResults(self, a, b, rtol=1e-05):
+        """Check equality of dictionaries of arrays (NaN are equal)."""
+        self.assertEqual(sorted(a), sorted(b))
+        for key in a:
+            self.assertEqual(np.shape(a[key]), np.shape(b[key]), key)
+            self.assertTrue(
+                np.allclose(a[key], b[key], rtol=rtol, equal_nan=True), key)
+
+
+class ArrayEncodingTest(unittest.TestCase):
+
+    def test_roundTrip(self):
+        arrays = [
+            np.arange(12.).reshape(3, 4),
+            np.arange(6, dtype='>i4')[::2],
+            np.zeros((0, 3)),
+            np.array(['2020-01-01T00:00', '2021-02-03T04:05'], dtype='M8[s]'),
+            np.array([1, 2], dtype='m8[ms]'),
+            np.zeros(3, dtype=[('a', 'i4'), ('b', 'f8')]),
+            np.array(['ab', 'c'])]
+        for arr in arrays:
+            for compressSize in (None, 0):
+                with self.subTest(dtype=arr.dtype, compress=compressSize):
+                    result = pdb.decodeArray(
+                        pdb.encodeArray(arr, compressSize))
+                    self.assertEqual(result.dtype, arr.dtype)
+                    self.assertEqual(result.shape, arr.shape)
+                    self.assertTrue(np.array_equal(result, arr))
+
+
+class ReflectionsTest(SynthTestCase):
+    """Vectorized paths are the original per-line loops."""
+
+    def test_intervalRanges(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                ranges = A.getIntervalRanges()
+                ranges = ranges.reshape((-1,) + ranges.shape[-2:])
+                i_h = np.arange(A.heights.size)
+                for (hmin, hmax), parts in zip(
+                        A.intervals.reshape(-1, 2), ranges):
+                    inside = (A.heights >= hmin) & (A.heights <= hmax)
+                    covered = np.zeros_like(inside)
+                    for start, stop in parts:
+                        covered |= (i_h >= start) & (i_h < stop)
+                    self.assertTrue(np.array_equal(covered, inside))
+
+    def test_reflectionIndexes(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                arr_abs, arr_c = A.getUnits(0, A.units)
+                indexes = A.getReflectionIndexes(
+                    arr_abs, A.getTheresholds(arr_abs))
+                for i in range(A.units):
+                    self.assertTrue(np.array_equal(
+                        indexes[i], lineUnitIndexes(A, i)[2]), i)
+                    self.assertTrue(np.array_equal(
+                        indexes[i, :, :2],
+                        [A.getReflectionIndex(j, arr_abs[i, j],
+                                              np.mean(arr_abs[i, j]) +
+                                              np.std(arr_abs[i, j]))[:2]
+                         for j in range(arr_abs.shape[1])]), i)
+
+    def test_indexesGaps(self):
+        A = pf.parusFile(self.files[1])
+        rng = np.random.default_rng(0)
+        for n_times in (1, 2, 5, 50):
+            for missed in (0., 0.3, 0.8, 1.):
+                with self.subTest(times=n_times, missed=missed):
+                    indexes = rng.integers(0, 256, (n_times, 4, 2))
+                    indexes[rng.random(indexes.shape) < missed] = -9999
+                    expected = np.empty_like(indexes)
+                    for j in range(4):
+                        for k in range(2):
+                            expected[:, j, k] = lineFillGaps(indexes[:, j, k])
+                    self.assertTrue(np.array_equal(
+                        A.fillIndexesGaps(indexes), expected))
+
+    def test_hardCalculation(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname, blockSize=32)
+                expected = lineHardCalculation(A)
+                self.assertSameResults(A.HardCalculation(), expected)
+                self.assertSameResults(
+                    A.HardCalculation(streaming=True), expected)
+
+    def test_spectralCalculation(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname, blockSize=32)
+                # signal is kept in single precision
+                self.assertSameResults(
+                    A.SpectralCalculation(), lineSpectralCalculation(A),
+                    rtol=1e-6)
+
+    def test_spectralGaps(self):
+        for version, fname in self.files.items():
+            A = pf.parusFile(fname)
+            arr_c = A.getUnits(0, A.units)[1]
+            # no second reflection of the first frequency
+            for start, stop in A.getIntervalRanges()[0, 1]:
+                arr_c[:, 0, start:stop] = 0
+            # no reflections of other frequencies in leading, interior
+            # and trailing gaps (the peak is below intervals)
+            for units in (slice(0, 3), slice(30, 46), slice(90, None)):
+                arr_c[units, 1:] = 1
+                arr_c[units, 1:, 5] = 1000
+            expected = lineSpectralCalculation(A, arr_c)
+
+            for blockSize in (1, 7, 32, A.units):
+                with self.subTest(version=version, blockSize=blockSize):
+                    acc = ps.spectralAccumulator(A)
+                    for i in range(0, A.units, blockSize):
+                        block = arr_c[i:i + blockSize]
+                        acc.update(np.abs(block), block)
+                    self.assertSameResults(acc.result(), expected, rtol=1e-6)
+
+
+class AccumulateTest(SynthTestCase):
+    """Single pass of analyses gives results of their methods."""
+
+    def test_fullCalculation(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname, blockSize=32)
+                results = A.FullCalculation()
+                for name, (accumulator, method, kwargs) in \
+                        A.analyses.items():
+                    self.assertSameResults(
+                        results[name], getattr(A, method)(**kwargs))
+
+    def test_unitsRange(self):
+        start, stop = 37, 83
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname, blockSize=16)
+                results = A.accumulate(dict(
+                    (name, accumulator(A)) for name, (accumulator, _, _)
+                    in A.analyses.items()), start, stop)
+
+                # file with units from start to stop only
+                unitSize = A._mmap[0].nbytes
+                part = os.path.join(self.directory, 'part.frq')
+                with open(fname, 'rb') as f, open(part, 'wb') as out:
+                    out.write(f.read(A._datapos))
+                    f.seek(A._datapos + start * unitSize)
+                    out.write(f.read((stop - start) * unitSize))
+                B = pf.parusFile(part)
+                self.assertEqual(B.units, stop - start)
+                for name, (accumulator, method, kwargs) in \
+                        B.analyses.items():
+                    self.assertSameResults(
+                        results[name], getattr(B, method)(**kwargs))
+
+
+class TheresholdsTest(SynthTestCase):
+    """Theresholds of blocks are the per-line definitions."""
+
+    methods = {
+        'std': lambda arr, factor=1.: np.mean(arr) + factor * np.std(arr),
+        'iqr': lineIqrThereshold,
+        'mad': lineMadThereshold}
+
+    def test_methods(self):
+        for version, fname in self.files.items():
+            for method, line in self.methods.items():
+                for factor in (None, 2.):
+                    with self.subTest(
+                            version=version, method=method, factor=factor):
+                        A = pf.parusFile(
+                            fname, theresholdMethod=method,
+                            theresholdFactor=factor)
+                        arr_abs = A.getUnits(0, 20)[0]
+                        options = {} if factor is None else {'factor': factor}
+                        expected = np.array([
+                            [line(arr, **options) for arr in unit]
+                            for unit in arr_abs])
+                        self.assertTrue(np.allclose(
+                            A.getTheresholds(arr_abs), expected))
+
+    def test_unknownMethod(self):
+        with self.assertRaises(ValueError):
+            pf.parusFile(self.files[1], theresholdMethod='max')
+
+
+class PrecisionTest(SynthTestCase):
+    """Single precision and integer decode modes."""
+
+    def test_single(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                S = pf.parusFile(fname, precision='single')
+                arr_abs, arr_c = A.getUnits(0, 10)
+                s_abs, s_c = S.getUnits(0, 10)
+                self.assertEqual(s_abs.dtype, np.float32)
+                self.assertEqual(s_c.dtype, np.complex64)
+                # quadratures are integers of 14 bits, they are exact
+                self.assertTrue(np.array_equal(s_c, arr_c))
+                self.assertTrue(np.allclose(s_abs, arr_abs, rtol=1e-6))
+                self.assertSameResults(
+                    S.HardCalculation(), A.HardCalculation(), rtol=1e-4)
+
+    def test_integers(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                arr_c = A.getUnits(0, 10)[1]
+                quadratures = A.getQuadratures(0, 10)
+                self.assertEqual(quadratures.dtype, np.int16)
+                self.assertTrue(np.array_equal(
+                    quadratures[..., 0], arr_c.real))
+                self.assertTrue(np.array_equal(
+                    quadratures[..., 1], arr_c.imag))
+                powers = A.getPowers(0, 10)
+                self.assertEqual(powers.dtype, np.int32)
+                self.assertTrue(np.array_equal(
+                    powers, arr_c.real**2 + arr_c.imag**2))
+
+
+class SelectionTest(SynthTestCase):
+    """Selection of frequencies and heights windows."""
+
+    def test_frequencies(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                frqs = A.frqs[[1, 3]]
+                B = pf.parusFile(fname, frqs=frqs)
+                self.assertTrue(np.array_equal(B.frqs, frqs))
+
+                full = A.HardCalculation()
+                self.assertSameResults(
+                    dict((key, value[[1, 3]]) for key, value in full.items()),
+                    B.HardCalculation())
+                full = A.SpectralCalculation()
+                part = B.SpectralCalculation()
+                self.assertTrue(np.allclose(
+                    full['signal'][:, [1, 3]], part['signal'],
+                    equal_nan=True))
+                self.assertTrue(np.allclose(
+                    full['h_eff'][[1, 3]], part['h_eff']))
+
+    def test_windows(self):
+        # windows change theresholds, they are selected explicitly
+        windows = [(95, 135), (190, 230)]
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                with self.assertRaises(ValueError):
+                    pf.parusFile(fname, windows=windows)
+                C = pf.parusFile(
+                    fname, windows=windows, localTheresholds=True)
+                self.assertEqual(C.heights[-1], A.heights[-1])
+                self.assertNotEqual(
+                    C.getConfiguration(), A.getConfiguration())
+
+
+class FollowTest(SynthTestCase):
+    """Reading of the file which is still written."""
+
+    def test_growingFile(self):
+        for version, fname in self.files.items():
+            with self.subTest(version=version):
+                A = pf.parusFile(fname)
+                with open(fname, 'rb') as f:
+                    data = f.read()
+                unitSize = (len(data) - A._datapos) // A.units
+                grow = os.path.join(self.directory, 'grow.frq')
+                # header and 10.5 units
+                size = A._datapos + 10 * unitSize + unitSize // 2
+                with open(grow, 'wb') as f:
+                    f.write(data[:size])
+
+                B = pf.parusFile(grow)
+                self.assertEqual(B.units, 10)
+                self.assertEqual(B.refresh(), 0)
+                blocks = B.followUnits(blockSize=16, interval=0, timeout=0)
+                i, arr_abs, arr_c = next(blocks)
+                self.assertEqual((i, arr_c.shape[0]), (0, 10))
+
+                with open(grow, 'ab') as f:
+                    f.write(data[size:])
+                units = [arr_c] + [block[2] for block in blocks]
+                self.assertEqual(B.units, A.units)
+                self.assertTrue(np.array_equal(
+                    np.concatenate(units), A.getUnits(0, A.units)[1]))
+
+    def test_headerOnly(self):
+        A = pf.parusFile(self.files[1])
+        grow = os.path.join(self.directory, 'grow.frq')
+        with open(self.files[1], 'rb') as f:
+            data = f.read()
+        with open(grow, 'wb') as f:
+            f.write(data[:A._datapos])
+
+        B = pf.parusFile(grow)
+        self.assertEqual(B.units, 0)
+        self.assertEqual(list(B.iterUnits()), [])
+        stats = B.getStatistics()
+        for key, arr in stats.items():
+            self.assertEqual(arr.shape, A.getStatistics()[key].shape)
+            self.assertTrue(np.all(np.isnan(arr)))
+        self.assertTrue(np.all(np.isnan(B.getAveragedMeans()[0])))
+        with open(grow, 'ab') as f:
+            f.write(data[A._datapos:])
+        self.assertEqual(B.refresh(), A.units)
+        self.assertSameResults(B.HardCalculation(), A.HardCalculation())
+
+
+class CatalogTest(unittest.TestCase):
+    """Persistent catalog of files headers."""
+
+    def setUp(self):
+        self._temporary = tempfile.TemporaryDirectory()
+        self.directory = self._temporary.name
+        self.names = []
+        for i, version in enumerate((0, 1, 2)):
+            fname = os.path.join(self.directory, 'file{}.frq'.format(i))
+            syn.writeFrq(
+                fname, version=version, units=20 + i, seed=i,
+                frqs=(1600 + 100 * i, 2500),
+                tm=time.strptime('2020-01-0{} 12:00'.format(i + 1),
+                                 '%Y-%m-%d %H:%M'))
+            self.names.append(fname)
+
+    def tearDown(self):
+        self._temporary.cleanup()
+
+    def test_refresh(self):
+        catalog = pc.parusCatalog(self.directory)
+        try:
+            self.assertEqual(catalog.refresh(), 3)
+            self.assertEqual(catalog.refresh(), 0)
+            self.assertEqual(catalog.names(), self.names)
+            for rec in catalog.records():
+                header = pf.scanHeader(rec.path)
+                self.assertEqual(rec.version, header.version)
+                self.assertEqual(rec.units, header.units)
+                self.assertTrue(np.array_equal(rec.frqs, header.frqs))
+            self.assertEqual(catalog.names(frqs=[1700]), self.names[1:2])
+            self.assertEqual(
+                catalog.names(time_from=datetime(2020, 1, 2)),
+                self.names[1:])
+            self.assertTrue(np.array_equal(
+                catalog.frequencies(), [1600, 1700, 1800, 2500]))
+        finally:
+            catalog.close()
+
+    def test_invalidation(self):
+        catalog = pc.parusCatalog(self.directory)
+        catalog.refresh()
+        catalog.close()
+
+        # catalog is persistent
+        catalog = pc.parusCatalog(self.directory)
+        try:
+            self.assertEqual(catalog.refresh(), 0)
+
+            # changed, removed and unreadable files
+            syn.writeFrq(self.names[0], version=0, units=30, seed=5)
+            os.remove(self.names[1])
+            bad = os.path.join(self.directory, 'bad.frq')
+            with open(bad, 'wb') as f:
+                f.write(b'\0' * 10)
+            self.assertEqual(catalog.refresh(), 2)
+            self.assertEqual(
+                catalog.names(), [self.names[2], self.names[0]])
+            self.assertEqual(
+                [rec.units for rec in catalog.records()], [22, 30])
+            self.assertEqual(catalog.unreadable(), [bad])
+        finally:
+            catalog.close()
+
+
+class WriterTest(SynthTestCase):
+    """Bulk writer is the original row-by-row path."""
+
+    def test_hardResults(self):
+        files = [pb.processFile(fname) for fname in self.files.values()]
+        # the second save of the file updates absorbtion only
+        files.append(files[0])
+
+        con = sqlite3.connect(':memory:')
+        con.executescript(pbench.hardSchema)
+        writer = pdb.parusWriter(con, batchSize=2)
+        for info, results in files:
+            writer.addHardResults(info, results)
+        writer.close()
+
+        old = sqlite3.connect(':memory:')
+        old.executescript(pbench.hardSchema)
+        cur = old.cursor()
+        for info, results in files:
+            lineAddHardResults(cur, info, results)
+            old.commit()
+
+        for text in (
+                'SELECT * FROM files ORDER BY id_file',
+                'SELECT * FROM frequencies ORDER BY id_frq',
+                'SELECT ampl_file, ampl_frq, number, a_eff, a_std, n_std, '
+                'h_eff, h_std, L_mean, counts FROM amplitudes '
+                'ORDER BY ampl_file, ampl_frq, number'):
+            with self.subTest(text=text):
+                rows = con.execute(text).fetchall()
+                self.assertTrue(rows)
+                self.assertEqual(rows, old.execute(text).fetchall())
+        con.close()
+        old.close()
+
+    def test_ingested(self):
+        con = sqlite3.connect(':memory:')
+        con.executescript(pbench.hardSchema)
+        info, results = pb.processFile(self.files[1])
+        writer = pdb.parusWriter(con)
+        self.assertFalse(writer.isIngested(info['name']))
+        writer.addHardResults(info, results)
+        writer.close()
+        self.assertTrue(pdb.parusWriter(con).isIngested(info['name']))
+        con.close()
+
+    def test_synchronous(self):
+        # default mode of the session (FULL) is kept without WAL
+        with tempfile.TemporaryDirectory() as directory:
+            for i, (options, mode) in enumerate((
+                    ({}, 2), ({'synchronous': 'NORMAL'}, 1),
+                    ({'wal': True}, 1),
+                    ({'wal': True, 'synchronous': 'FULL'}, 2))):
+                with self.subTest(**options):
+                    con = sqlite3.connect(
+                        os.path.join(directory, '{}.sqlite'.format(i)))
+                    con.executescript(pbench.hardSchema)
+                    pdb.parusWriter(con, **options)
+                    self.assertEqual(
+                        con.execute('PRAGMA synchronous').fetchone()[0],
+                        mode)
+                    con.close()
+
+
+class BatchCacheTest(SynthTestCase):
+    """Files of the batch share the cache of the process."""
+
+    def test_sharedCache(self):
+        cacheDir = os.path.join(self.directory, 'cache')
+        names = list(self.files.values())
+        for info, results in pb.iterResults(names, cacheDir=cacheDir):
+            pass
+        cache = pb.getCache(cacheDir)
+        self.assertIs(cache, pb.getCache(cacheDir))
+        self.assertIsNone(pb.getCache(None))
+
+        # size is known after the first eviction and counted by saves
+        size = sum(
+            os.path.getsize(os.path.join(root, name))
+            for root, dirs, files in os.walk(cacheDir) for name in files)
+        self.assertEqual(cache._size, size)
+        shutil.rmtree(cacheDir)
+
+
+class WatchTest(SynthTestCase):
+    """Files of the watched directory are ready when units are complete."""
+
+    def test_readyFiles(self):
+        fname = self.files[1]
+        A = pf.parusFile(fname)
+        unitSize = A._mmap[0].nbytes
+        with open(fname, 'rb') as f:
+            data = f.read()
+        names = []
+        for name, size in (
+                ('header.frq', A._datapos),
+                ('short.frq', 100),
+                ('partial.frq', A._datapos + 3 * unitSize + 10),
+                ('full.frq', len(data))):
+            names.append(os.path.join(self.directory, name))
+            with open(names[-1], 'wb') as f:
+                f.write(data[:size])
+
+        con = sqlite3.connect(':memory:')
+        con.executescript(pbench.hardSchema)
+        writer = pdb.parusWriter(con)
+        sizes = {}
+        failed = {}
+        self.assertEqual(pb.readyFiles(names, writer, sizes, 0, failed), [])
+        self.assertEqual(
+            pb.readyFiles(names, writer, sizes, 0, failed), names[3:])
+        # incomplete files are checked again
+        self.assertEqual(sorted(sizes), sorted(names))
+
+        with open(names[2], 'r+b') as f:
+            f.truncate(A._datapos + 3 * unitSize)
+        pb.readyFiles(names, writer, sizes, 0, failed)
+        self.assertEqual(
+            pb.readyFiles(names, writer, sizes, 0, failed), names[2:])
+        writer.close()
+        con.close()
+
+
+@unittest.skipIf(iview3 is None, 'ion/iview3.py can not be imported')
+class IonTest(unittest.TestCase):
+    """Parsing of ionograms is the original per-byte parser."""
+
+    # ionograms: O outliers only, with X outliers, with outliers
+    # crossing the bounds of heights
+    ionograms = {
+        'plain': {},
+        'x': {'outliers_x': 3},
+        'overflow': {
+            'outliers': 4, 'outliers_x': 2, 'overflow': True,
+            'height_min': 60000}}
+
+    @classmethod
+    def setUpClass(cls):
+        cls._temporary = tempfile.TemporaryDirectory()
+        cls.directory = cls._temporary.name
+        cls.files = {}
+        for name, options in cls.ionograms.items():
+            cls.files[name] = os.path.join(
+                cls.directory, '{}.ion'.format(name))
+            syn.writeIon(
+                cls.files[name], count_freq=120, count_height=256,
+                **options)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._temporary.cleanup()
+
+    def assertSameIonogram(self, a, b):
+        self.assertEqual(a['params'], b['params'])
+        self.assertTrue(np.array_equal(a['frqs'], b['frqs']))
+        self.assertEqual(a['data'].dtype, b['data'].dtype)
+        self.assertTrue(np.array_equal(a['data'], b['data']))
+
+    def test_readDataFile(self):
+        for name, fname in self.files.items():
+            with self.subTest(ionogram=name):
+                expected = lineReadIon(fname)
+                self.assertTrue(np.any(expected['data']))
+                self.assertSameIonogram(iview3.readDataFile(fname), expected)
+
+    def test_lineIndex(self):
+        for name, fname in self.files.items():
+            with self.subTest(ionogram=name):
+                lines = iview3.getLineIndex(fname)
+                full = iview3.readDataFile(fname)
+                self.assertTrue(np.array_equal(
+                    lines['frequency'], full['frqs']))
+                self.assertEqual(
+                    lines['offset'][0], struct.calcsize(
+                        iview3.formatFileHeader))
+                self.assertTrue(np.array_equal(
+                    lines['offset'][1:],
+                    lines['offset'][:-1] + lines['size'][:-1]))
+                self.assertEqual(
+                    lines['offset'][-1] + lines['size'][-1],
+                    os.path.getsize(fname))
+
+    def test_frequencyRange(self):
+        for name, fname in self.files.items():
+            full = lineReadIon(fname)
+            frqs = full['frqs']
+            for freq_from, freq_to in (
+                    (frqs[0], None), (frqs[17], frqs[17]),
+                    (frqs[10] + 1, frqs[60] - 1), (frqs[-5], 20000),
+                    (0, frqs[0] - 1), (0, 20000)):
+                with self.subTest(
+                        ionogram=name, range=(freq_from, freq_to)):
+                    last = freq_from if freq_to is None else freq_to
+                    columns = (frqs >= freq_from) & (frqs <= last)
+                    self.assertSameIonogram(
+                        iview3.readFrequencyRange(fname, freq_from, freq_to),
+                        {'params': full['params'],
+                         'data': full['data'][:, columns],
+                         'frqs': frqs[columns]})
+
+    def test_staleIndex(self):
+        fname = os.path.join(self.directory, 'stale.ion')
+        syn.writeIon(fname, count_freq=120, seed=1)
+        iview3.getLineIndex(fname)
+        mtime = os.stat(fname).st_mtime_ns
+
+        # the ionogram is replaced, the sidecar index is older
+        syn.writeIon(fname, count_freq=120, seed=2, outliers_x=2)
+        os.utime(fname, ns=(mtime + 10**9, mtime + 10**9))
+        full = lineReadIon(fname)
+        frqs = full['frqs']
+        columns = (frqs >= frqs[30]) & (frqs <= frqs[40])
+        self.assertSameIonogram(
+            iview3.readFrequencyRange(fname, frqs[30], frqs[40]),
+            {'params': full['params'], 'data': full['data'][:, columns],
+             'frqs': frqs[columns]})
+
+        # broken sidecar index is built again
+        with open(fname + iview3.lineIndexSuffix, 'wb') as f:
+            f.write(b'broken')
+        self.assertSameIonogram(
+            iview3.readFrequencyRange(fname, frqs[0], frqs[-1]), full)
+
+
+class SpectralDatabaseTest(unittest.TestCase):
+    """Query of the spectral results table (no number column)."""
+
+    def setUp(self):
+        self.db = pdb.parusDB(
+            os.path.join(moduleDirectory, 'parus_psd.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_results(self):
+        self.assertFalse(self.db.hasNumbers())
+        results = self.db.getResults()
+        count, = self.db._con.execute(
+            'SELECT count(*) FROM amplitudes').fetchone()
+        self.assertEqual(results.size, count)
+        self.assertTrue(np.all(results['number'] == -1))
+        self.assertTrue(
+            np.all(np.diff(results['time']) >= np.timedelta64(0, 's')))
+
+        frq = results['frequency'][0]
+        part = self.db.getResults(columns=['power0'], frqs=[frq])
+        self.assertEqual(part.dtype.names[-1], 'power0')
+        self.assertEqual(
+            part.size, np.count_nonzero(results['frequency'] == frq))
+
+    def test_numbers(self):
+        with self.assertRaises(ValueError):
+            self.db.getResults(numbers=[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 import sys
 import argparse
 import os
+import tempfile
 import numpy
 import matplotlib.pyplot as plt
 
@@ -10,6 +11,26 @@ from struct import *
 
 import pdb
 
+# =============================================================================
+# Описания структур файла ионограммы (см. readFileHeader,
+# readFrequencyHeader, readOutlierHeader).
+formatFileHeader = "=I 9i 8I"
+keysFileHeader = ('ver',
+                  'tm_sec','tm_min','tm_hour',
+                  'tm_mday','tm_mon','tm_year',
+                  'tm_wday','tm_yday','tm_isdst',
+                  'height_min','height_step','count_height',
+                  'switch_frequency',
+                  'freq_min','freq_max','count_freq',
+                  'count_modules')
+formatFrequencyHeader = "=3H 7B"
+formatOutlierHeader = "=L H"
+# Индекс частотных строк: частота, смещение и размер строки с выбросами.
+lineIndexDtype = numpy.dtype(
+    [('frequency', numpy.uint16), ('offset', numpy.int64),
+     ('size', numpy.int64)])
+lineIndexSuffix = '.idx'
+
 # =============================================================================
 def createParser ():
     """Создание парсера командной строки."""
@@ -75,31 +96,12 @@ def readDataFile(fname):
     fname - имя файла ионограммы.
     """
 
-    # Open a data file.
+    # Весь файл читается одним блоком, заголовки разбираются по смещениям.
     with open(fname, 'rb') as fid:
-        properties = readFileHeader(fid)
-        count_height = properties['count_height']
-        count_freq = properties['count_freq']
-        data = numpy.zeros((count_height,count_freq), dtype=numpy.uint8)
-        frqs = numpy.zeros(count_freq, dtype=numpy.int)
-        i = 0
-        while True:
-            headerLine = readFrequencyHeader(fid)
-            if not headerLine:
-                break
-            line = readLine(fid, properties, headerLine)
-            tmp = line['line']
-            data[:,i] = tmp
-            frqs[i] = line['frequency']
-            i = i + 1
-
-        # data = fid.read()
-        # a = numpy.frombuffer(data, numpy.dtype(numpy.int16))
-        # aa = numpy.right_shift(a,2)
-        # c = numpy.array(aa[::2])+1j*numpy.array(aa[1::2])
-        # d = numpy.absolute(c)
-        # data = numpy.transpose(numpy.reshape(
-        #     d,(properties['ks'],properties['count'])))
+        buf = fid.read()
+
+    properties = parseFileHeader(buf)
+    data, frqs = parseLines(buf, calcsize(formatFileHeader), properties)
 
     return {'params':properties, 'data':data, 'frqs':frqs }
 
@@ -137,20 +139,213 @@ def readFileHeader(fid):
 # tm_yday	int	days since January 1	0-365
 # tm_isdst	int	Daylight Saving Time flag
 # =========================================================================
-    format1 = "=I 9i 8I" # struct description
-    params = fid.read(calcsize(format1))
-    properties = unpack(format1, params)
-    keys = ('ver',
-            'tm_sec','tm_min','tm_hour',
-            'tm_mday','tm_mon','tm_year',
-            'tm_wday','tm_yday','tm_isdst',
-            'height_min','height_step','count_height',
-            'switch_frequency',
-            'freq_min','freq_max','count_freq',
-            'count_modules')
-    properties = dict(zip(keys,properties))
-
-    return properties
+    params = fid.read(calcsize(formatFileHeader))
+
+    return parseFileHeader(params)
+
+# =============================================================================
+def parseFileHeader(buf):
+    """Возвращает заголовок файла ионограммы из начала буфера в виде
+    словаря с ключами параметров.
+
+    Аргументы:
+    buf - содержимое файла ионограммы (bytes).
+    """
+    properties = unpack_from(formatFileHeader, buf)
+
+    return dict(zip(keysFileHeader, properties))
+
+# =============================================================================
+def parseLines(buf, offset, headerIonogram):
+    """Возвращает матрицу амплитуд (высоты x частоты) и массив частот,
+    разобранные из буфера начиная с заданного смещения.
+
+    Заголовки разбираются по смещениям в буфере, отсчеты всех выбросов
+    копируются в матрицу одной операцией, выбросы компоненты X
+    пропускаются.
+
+    Аргументы:
+    buf - содержимое файла ионограммы (bytes),
+    offset - смещение первой частотной строки,
+    headerIonogram - заголовок ионограммы.
+    """
+    count_height = headerIonogram['count_height']
+    count_freq = headerIonogram['count_freq']
+    dh = headerIonogram['height_step']
+    h0 = headerIonogram['height_min']
+
+    data = numpy.zeros((count_height, count_freq), dtype=numpy.uint8)
+    frqs = numpy.zeros(count_freq, dtype=int)
+
+    line_header = Struct(formatFrequencyHeader)
+    outlier_header = Struct(formatOutlierHeader)
+    unpack_line = line_header.unpack_from
+    unpack_outlier = outlier_header.unpack_from
+    line_size = line_header.size
+    outlier_size = outlier_header.size
+    size = len(buf)
+    # частоты строк; начальные высоты, столбцы, смещения и длины
+    # всплесков (в границах высот ионограммы)
+    frequencies = []
+    rows = []
+    cols = []
+    starts = []
+    lengths = []
+    pos = offset
+    i = 0
+    while pos + line_size <= size and i < count_freq:
+        headerLine = unpack_line(buf, pos)
+        pos += line_size
+        frequencies.append(headerLine[0])
+        count_o, count_x = headerLine[-2:]
+        for j in range(count_o + count_x):
+            height_begin, count_samples = unpack_outlier(buf, pos)
+            pos += outlier_size
+            if j < count_o:
+                # начальный номер текущего всплеска
+                ind = (height_begin - h0)//dh
+                begin = max(ind, 0)
+                end = min(ind + count_samples, count_height)
+                if begin < end:
+                    rows.append(begin)
+                    cols.append(i)
+                    starts.append(pos + begin - ind)
+                    lengths.append(end - begin)
+            pos += count_samples
+        i = i + 1
+    frqs[:i] = frequencies
+
+    if lengths:
+        # Все всплески копируются одной операцией. Номера отсчетов в
+        # буфере и ячеек матрицы растут на постоянный шаг внутри
+        # всплеска, поэтому получаются накопленной суммой шагов со
+        # скачками в начале каждого всплеска.
+        lengths = numpy.array(lengths, dtype=numpy.int64)
+        starts = numpy.array(starts, dtype=numpy.int64)
+        cells = numpy.array(rows, dtype=numpy.int64)*count_freq + cols
+        offsets = numpy.cumsum(lengths) - lengths
+        ends = lengths - 1
+
+        src = numpy.ones(offsets[-1] + lengths[-1], dtype=numpy.int64)
+        src[offsets[0]] = starts[0]
+        src[offsets[1:]] = starts[1:] - starts[:-1] - ends[:-1]
+        dst = numpy.full(src.size, count_freq, dtype=numpy.int64)
+        dst[offsets[0]] = cells[0]
+        dst[offsets[1:]] = cells[1:] - cells[:-1] - ends[:-1]*count_freq
+
+        samples = numpy.frombuffer(buf, dtype=numpy.uint8)
+        data.reshape(-1)[numpy.cumsum(dst)] = samples[numpy.cumsum(src)]
+
+    return data, frqs
+
+# =============================================================================
+def buildLineIndex(buf, offset, count_freq):
+    """Возвращает индекс частотных строк (массив lineIndexDtype),
+    построенный за один проход по заголовкам без чтения отсчетов.
+
+    Аргументы:
+    buf - содержимое файла ионограммы (bytes),
+    offset - смещение первой частотной строки,
+    count_freq - число частот ионограммы.
+    """
+    unpack_line = Struct(formatFrequencyHeader).unpack_from
+    unpack_outlier = Struct(formatOutlierHeader).unpack_from
+    line_size = calcsize(formatFrequencyHeader)
+    outlier_size = calcsize(formatOutlierHeader)
+    size = len(buf)
+
+    lines = []
+    pos = offset
+    while pos + line_size <= size and len(lines) < count_freq:
+        begin = pos
+        headerLine = unpack_line(buf, pos)
+        pos += line_size
+        for j in range(headerLine[-2] + headerLine[-1]):
+            height_begin, count_samples = unpack_outlier(buf, pos)
+            pos += outlier_size + count_samples
+        lines.append((headerLine[0], begin, pos - begin))
+
+    return numpy.array(lines, dtype=lineIndexDtype)
+
+# =============================================================================
+def getLineIndex(fname):
+    """Возвращает индекс частотных строк файла ионограммы.
+
+    Индекс хранится в файле рядом с ионограммой (имя + lineIndexSuffix)
+    и строится заново, если размер или время изменения ионограммы
+    не совпадают с сохраненными.
+
+    Аргументы:
+    fname - имя файла ионограммы.
+    """
+    st = os.stat(fname)
+    stamp = numpy.array([st.st_size, st.st_mtime_ns], dtype=numpy.int64)
+    index_name = fname + lineIndexSuffix
+    try:
+        with numpy.load(index_name) as cached:
+            if numpy.array_equal(cached['stamp'], stamp):
+                return cached['lines']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open(fname, 'rb') as fid:
+        buf = fid.read()
+    properties = parseFileHeader(buf)
+    lines = buildLineIndex(
+        buf, calcsize(formatFileHeader), properties['count_freq'])
+
+    # Индекс не сохраняется в каталоги только для чтения.
+    try:
+        fd, tmp = tempfile.mkstemp(
+            suffix='.tmp', dir=os.path.dirname(os.path.abspath(fname)))
+        with os.fdopen(fd, 'wb') as f:
+            numpy.savez(f, stamp=stamp, lines=lines)
+        os.replace(tmp, index_name)
+    except OSError:
+        pass
+
+    return lines
+
+# =============================================================================
+def readFrequencyRange(fname, freq_from, freq_to=None):
+    """Возвращает параметры и данные частотных строк ионограммы из
+    диапазона частот в виде словаря с ключами 'params', 'data' и 'frqs'
+    (как readDataFile). Читаются только байты выбранных строк.
+
+    Аргументы:
+    fname - имя файла ионограммы,
+    freq_from - начальная частота диапазона, кГц,
+    freq_to - конечная частота диапазона, кГц (равна начальной,
+    если не задана).
+    """
+    if freq_to is None:
+        freq_to = freq_from
+    lines = getLineIndex(fname)
+    selected = numpy.nonzero(
+        (lines['frequency'] >= freq_from) &
+        (lines['frequency'] <= freq_to))[0]
+
+    with open(fname, 'rb') as fid:
+        properties = readFileHeader(fid)
+        if selected.size:
+            # строки читаются одним блоком от первой до последней
+            first = lines[selected[0]]
+            last = lines[selected[-1]]
+            fid.seek(first['offset'])
+            buf = fid.read(last['offset'] + last['size'] - first['offset'])
+        else:
+            buf = b''
+
+    span = dict(properties)
+    span['count_freq'] = 0 if not selected.size else \
+        selected[-1] - selected[0] + 1
+    data, frqs = parseLines(buf, 0, span)
+    if selected.size:
+        columns = selected - selected[0]
+        data = data[:, columns]
+        frqs = frqs[columns]
+
+    return {'params':properties, 'data':data, 'frqs':frqs }
 
 # =============================================================================
 def readFrequencyHeader(fid):
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Пакетная отрисовка ионограмм в файлы PNG без графического интерфейса.
+"""
+import argparse
+import datetime
+import fnmatch
+import multiprocessing
+import os
+
+# Неинтерактивный вывод выбирается до загрузки pyplot (в iview3).
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import iview3
+
+# Фигура процесса, используется повторно для всех ионограмм.
+figure = None
+image = None
+
+# =============================================================================
+def createParser():
+    """Создание парсера командной строки."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'directory', nargs='?', default='.',
+        help='каталог файлов ионограмм')
+    parser.add_argument(
+        '-o', '--output', default=None,
+        help='каталог изображений (каталог ионограмм, если не задан)')
+    parser.add_argument(
+        '-p', '--pattern', default='*.ion',
+        help='шаблон имен файлов ионограмм')
+    parser.add_argument(
+        '-w', '--workers', type=int, default=os.cpu_count(),
+        help='число процессов')
+    parser.add_argument(
+        '--dpi', type=int, default=100,
+        help='разрешение изображений')
+    parser.add_argument(
+        '-f', '--force', action='store_true',
+        help='перерисовать изображения, новее ионограмм')
+
+    return parser
+
+# =============================================================================
+def getImageName(fname, output=None):
+    """Возвращает имя файла изображения для ионограммы.
+
+    Аргументы:
+    fname - имя файла ионограммы,
+    output - каталог изображений (каталог ионограммы, если None).
+    """
+    directory, name = os.path.split(fname)
+    if output is not None:
+        directory = output
+
+    return os.path.join(directory, os.path.splitext(name)[0] + '.png')
+
+# =============================================================================
+def isUpToDate(fname, imageName):
+    """Проверяет, что изображение новее файла ионограммы.
+
+    Аргументы:
+    fname - имя файла ионограммы,
+    imageName - имя файла изображения.
+    """
+    try:
+        return os.path.getmtime(imageName) >= os.path.getmtime(fname)
+    except OSError:
+        return False
+
+# =============================================================================
+def getTitle(params):
+    """Возвращает время ионограммы из заголовка в виде строки формата
+    "YYYY-mm-dd HH:MM:SS".
+
+    Аргументы:
+    params - заголовок файла ионограммы.
+    """
+    tm = datetime.datetime(params['tm_year'] + 1900,
+                           params['tm_mon'] + 1,
+                           params['tm_mday'],
+                           params['tm_hour'],
+                           params['tm_min'],
+                           params['tm_sec'])
+    return tm.strftime("%Y-%m-%d %H:%M:%S")
+
+# =============================================================================
+def getExtent(params):
+    """Возвращает границы ионограммы (МГц, км) для imshow.
+
+    Аргументы:
+    params - заголовок файла ионограммы.
+    """
+    return [params['freq_min']/1000,
+            params['freq_max']/1000,
+            params['height_min']/1000,
+            (params['count_height']-1)*params['height_step']/1000]
+
+# =============================================================================
+def initFigure(out):
+    """Создает фигуру процесса по первой ионограмме.
+
+    Аргументы:
+    out - словарь ионограммы (см. iview3.readDataFile).
+    """
+    global figure, image
+
+    figure = plt.figure()
+    axes = figure.add_subplot(1, 1, 1)
+    image = axes.imshow(out['data'],
+                        aspect='auto',
+                        origin='lower',
+                        extent=getExtent(out['params']))
+    axes.set_xlabel('f, MHz')
+    axes.set_ylabel('h, km')
+    axes.grid(True)
+
+# =============================================================================
+def renderFile(fname, output=None, dpi=100, force=False):
+    """Рисует ионограмму в файл PNG, возвращает имя изображения или
+    None, если изображение новее ионограммы.
+
+    Фигура процесса создается один раз, для следующих ионограмм
+    меняются только данные, границы и заголовок.
+
+    Аргументы:
+    fname - имя файла ионограммы,
+    output - каталог изображений (каталог ионограммы, если None),
+    dpi - разрешение изображения,
+    force - перерисовать новое изображение.
+    """
+    imageName = getImageName(fname, output)
+    if not force and isUpToDate(fname, imageName):
+        return None
+
+    out = iview3.readDataFile(fname)
+    if figure is None:
+        initFigure(out)
+    else:
+        image.set_data(out['data'])
+        image.set_extent(getExtent(out['params']))
+    image.autoscale()  # цветовая шкала по данным, как в iview3
+    image.axes.set_title(getTitle(out['params']))
+    figure.savefig(imageName, dpi=dpi)
+
+    return imageName
+
+# =============================================================================
+def renderTask(args):
+    """Задача процесса: (имя файла, каталог, dpi, force) -> (имя, ошибка)."""
+    fname, output, dpi, force = args
+    try:
+        return renderFile(fname, output, dpi, force), None
+    except Exception as e:
+        return fname, str(e)
+
+# =============================================================================
+# Основная программа
+if __name__ == '__main__':
+    parser = createParser()
+    namespace = parser.parse_args()
+
+    names = sorted(
+        os.path.join(namespace.directory, name)
+        for name in os.listdir(namespace.directory)
+        if fnmatch.fnmatch(name, namespace.pattern))
+    if namespace.output is not None:
+        os.makedirs(namespace.output, exist_ok=True)
+    # Устаревшие изображения отбираются до запуска процессов.
+    if not namespace.force:
+        names = [
+            name for name in names
+            if not isUpToDate(name, getImageName(name, namespace.output))]
+
+    tasks = [
+        (name, namespace.output, namespace.dpi, namespace.force)
+        for name in names]
+    rendered = 0
+    with multiprocessing.Pool(max(namespace.workers, 1)) as pool:
+        for name, error in pool.imap_unordered(renderTask, tasks):
+            if error is not None:
+                print('{}: {}'.format(name, error))
+            elif name is not None:
+                rendered += 1
+
+    print('{} of {} ionograms rendered.'.format(rendered, len(tasks)))
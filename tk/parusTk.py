@@ -3,7 +3,6 @@
 # импортирование модулей python
 from datetime import datetime
 import os.path as path
-import glob
 import os
 
 import tkinter as tk
@@ -17,6 +16,8 @@ import numpy as np
 import sys
 sys.path.append('../frq/')
 import parusFile as pf
+import parusCatalog as pc
+import parusCache as pcache
 import parusPlot as pplt
 
 # класс родительских окон
@@ -39,6 +40,9 @@ class Application(tk.Tk):
         # set the dimensions of the screen and where it is placed
         self.geometry('%dx%d+%d+%d' % (w, h, x, y))
 
+        # cache of results of analyses
+        self.cache = pcache.parusCache()
+
         self.menuCreate()
         self.initPopupMenu()
 
@@ -148,18 +152,19 @@ class Application(tk.Tk):
 
     def _build_data_for_directory(self, ext):
         cur_dir = self.directory
-        names = glob.glob(path.join(cur_dir, ext))
-        n_files = len(names)
+        # Collect information from the catalog of headers.
+        catalog = pc.parusCatalog(cur_dir, pattern=ext)
+        catalog.refresh()
+        records = catalog.records()
+        catalog.close()
         out_dict = {}
 
         i = 1
-        for name in names:
-            # Parsing data and collect information.
-            A = pf.parusFile(name)
-            ftime = datetime(*A.time[:6])
-            fsize = os.stat(name).st_size // 1024  # Kb
+        for rec in records:
+            ftime = datetime(*rec.time[:6])
+            fsize = rec.size // 1024  # Kb
 
-            out_dict[i] = [A.name, ftime, fsize, 0]
+            out_dict[i] = [rec.name, ftime, fsize, 0]
             i += 1
 
         return out_dict
@@ -230,7 +235,7 @@ class Application(tk.Tk):
 
     def onAverage(self):
         name = path.join(self.directory, self.cur_fname)
-        A = pf.parusFile(name)
+        A = pf.parusFile(name, cache=self.cache)
         ave, ave2, _h, _a_c = A.getAveragedMeans()
         _a = np.abs(_a_c)
         print(_h)
@@ -313,7 +318,7 @@ class Application(tk.Tk):
 
     def onAmplitude(self):
         name = path.join(self.directory, self.cur_fname)
-        A = pf.parusFile(name)
+        A = pf.parusFile(name, cache=self.cache)
 
         results = A.SpectralCalculation()
         # Plot amplitudes for two reflections.